@@ -20,12 +20,34 @@
 #	You should have received a copy of the GNU General Public License
 #	along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import pathoscope_util, os, math, csv
+import pathoscope_util, pathoscope_matrix, pathoscope_reader, pathoscope_report, pathoscope_profile
+import os, math, csv, tempfile, uuid
+import multiprocessing
+try:
+	import numpy
+except ImportError:
+	numpy = None
 # ===========================================================
-def conv_align2GRmat(aliDfile,pScoreCutoff,aliFormat):
-	in1 = open(aliDfile,'r')
+# stats, if given, is a dict that gets the number of non-header lines read
+def conv_align2GRmat(aliDfile,pScoreCutoff,aliFormat,compact=False,lineIndex=None,collapse=False,
+	stats=None):
+	if isinstance(aliDfile, basestring):
+		in1 = pathoscope_util.open_file(aliDfile,'r')
+	else:
+		in1 = aliDfile # already open stream, e.g. an aligner's stdout
+	lines = in1
+	header = None
+	if stats is not None:
+		lines = pathoscope_util.count_lines(in1, stats)
+		def header(ln):
+			stats['lines'] -= 1
+	# reads are collapsed into profile classes when the packed matrix is built
+	compact = compact or collapse
 	U = {}
 	NU = {}
+	if compact:
+		# typed-array storage; U and NU are returned as dict-like views
+		builder = pathoscope_matrix.GRMatrixBuilder('d' if aliFormat == 2 else 'H')
 	h_readId = {}
 	h_refId = {}
 	genomes = []
@@ -33,87 +55,54 @@ def conv_align2GRmat(aliDfile,pScoreCutoff,aliFormat):
 	gCnt = 0
 	rCnt = 0
 
-	mxBitSc = 700
-	sigma2 = 3
-	for ln in in1:
-		if (ln[0] == '@' or ln[0] == '#'):
-			continue
-
-		l = ln.split('\t')
-		
-		readId=l[0]
-		if (aliFormat == 0 or aliFormat == 1): # gnu-sam or sam
-			refId=l[2]
-		elif (aliFormat == 2): # bl8
-			refId=l[1]
-		
-		if refId == '*':
-			continue
-
-		if (aliFormat == 0): # gnu-sam
-			if len(l) < 13:
-				print "line has no score entry: %s" %(ln)
-				continue
-			scoreStringList = l[12].split(':')
-			if len(scoreStringList) < 3:
-				print "Number format error in line: %s" %(ln)
-				continue
-			pScore = float(scoreStringList[2])
-			if (pScore == float('Inf')):
-				pScore = 1.0
-			if (pScore < pScoreCutoff):
-				continue
-		elif (aliFormat == 1): # sam
-			mapq = float(l[4])
-			mapq2 = mapq/(-10.0)
-			pScore = 1.0 - pow(10,mapq2)
-			if (pScore < pScoreCutoff):
-				continue
-		elif (aliFormat == 2): # bl8
-			eVal = float(l[10])
-			if (eVal > pScoreCutoff):
-				continue
-			bitSc = float(l[11])/sigma2
-			if bitSc > mxBitSc:
-				bitSc = mxBitSc
-			pScore = math.exp(bitSc)
-		pScore = int(round(pScore*100)) # Converting to integer to conserve memory space
-		if pScore < 1:
-			continue
-		
-		gIdx = h_refId.get(refId,-1)
-		if gIdx == -1:
-			gIdx = gCnt
-			h_refId[refId] = gIdx
-			genomes.append(refId)
-			gCnt += 1
-
+	for (readId, alns) in pathoscope_reader.iter_read_groups(lines, aliFormat, pScoreCutoff, header):
 		rIdx = h_readId.get(readId,-1)
-		if rIdx == -1:
+		newRead = (rIdx == -1)
+		if newRead:
 			#hold on this new read
 			#first, wrap previous read profile and see if any previous read has a same profile with that!
 			rIdx = rCnt
 			h_readId[readId] = rIdx
 			read.append(readId)
 			rCnt += 1
-			U[rIdx] = [[gIdx], [pScore], [float(pScore)]]
-		else:
-			if (rIdx in U):
-				if gIdx in U[rIdx][0]:
+
+		for (refId, pScore, _, _, lineNo) in alns:
+			gIdx = h_refId.get(refId,-1)
+			if gIdx == -1:
+				gIdx = gCnt
+				h_refId[refId] = gIdx
+				genomes.append(refId)
+				gCnt += 1
+			if lineIndex is not None:
+				lineIndex.append(lineNo, rIdx, gIdx, newRead)
+
+			if compact:
+				builder.append(rIdx, gIdx, pScore)
+				newRead = False
+			elif newRead:
+				U[rIdx] = [[gIdx], [pScore], [float(pScore)]]
+				newRead = False
+			else:
+				if (rIdx in U):
+					if gIdx in U[rIdx][0]:
+						continue
+					NU[rIdx] = U[rIdx]
+					del U[rIdx]
+				if gIdx in NU[rIdx][0]:
 					continue
-				NU[rIdx] = U[rIdx]
-				del U[rIdx]
-			if gIdx in NU[rIdx][0]:
-				continue
-			NU[rIdx][0].append(gIdx)
-			NU[rIdx][1].append(pScore)
-			NU[rIdx][2][0] += pScore
-#			length = len(NU[rIdx][1])
-#			NU[rIdx][2] = [1.0/length]*length
+				NU[rIdx][0].append(gIdx)
+				NU[rIdx][1].append(pScore)
+				NU[rIdx][2][0] += pScore
+#				length = len(NU[rIdx][1])
+#				NU[rIdx][2] = [1.0/length]*length
 
-	in1.close()
+	if isinstance(aliDfile, basestring):
+		in1.close()
 
 	del h_refId, h_readId
+	if compact:
+		(U, NU) = builder.build(rCnt, gCnt, collapse)
+		return U, NU, genomes, read
 	for rIdx in U:
 		U[rIdx] = U[rIdx][0][0] #keep gIdx only
 	for rIdx in NU:
@@ -123,7 +112,83 @@ def conv_align2GRmat(aliDfile,pScoreCutoff,aliFormat):
 	return U, NU, genomes, read
 
 # ===========================================================
-def pathoscope_reassign(out_matrix, verbose, scoreCutoff, expTag, ali_format, ali_file, outdir, emEpsilon, maxIter, upalign):
+# conv_align2GRmat(compact=True) on nProc worker processes: the file is cut
+# into byte ranges at read boundaries (pathoscope_reader.shard_bounds),
+# each range parsed by pathoscope_reader.parse_shard, and the ranges merged
+# in file order, numbering reads and genomes by first appearance as the
+# serial loop does, so the result is the same. aliDfile must be a plain
+# (seekable, uncompressed) file: pathoscope_reassign parses streams and
+# compressed files serially
+# ===========================================================
+def conv_align2GRmat_sharded(aliDfile,pScoreCutoff,aliFormat,nProc,lineIndex=None,collapse=False,
+	stats=None):
+	pathoscope_matrix.require_numpy("conv_align2GRmat_sharded")
+	if not isinstance(aliDfile, basestring) or pathoscope_util.is_compressed(aliDfile):
+		raise ValueError("sharded parsing needs an uncompressed alignment file")
+	scoreType = 'd' if aliFormat == 2 else 'H'
+	builder = pathoscope_matrix.GRMatrixBuilder(scoreType)
+	bounds = pathoscope_reader.shard_bounds(aliDfile, 4*nProc)
+	jobs = [(aliDfile, bounds[k], bounds[k+1], aliFormat, pScoreCutoff, scoreType)
+		for k in range(len(bounds)-1)]
+	h_readId = {}
+	h_refId = {}
+	genomes = []
+	read = []
+	lineOffset = 0
+	pool = multiprocessing.Pool(nProc)
+	try:
+		for (shardRead, shardGenomes, r, g, score, lineNo, nLines) in pool.imap(
+			pathoscope_reader.parse_shard, jobs):
+			# shard-local read and genome indices -> global ones
+			rMap = numpy.empty(len(shardRead), dtype=numpy.int32)
+			for (k, readId) in enumerate(shardRead):
+				rIdx = h_readId.get(readId,-1)
+				if rIdx == -1:
+					rIdx = h_readId[readId] = len(read)
+					read.append(readId)
+				rMap[k] = rIdx
+			gMap = numpy.empty(len(shardGenomes), dtype=numpy.int32)
+			for (k, refId) in enumerate(shardGenomes):
+				gIdx = h_refId.get(refId,-1)
+				if gIdx == -1:
+					gIdx = h_refId[refId] = len(genomes)
+					genomes.append(refId)
+				gMap[k] = gIdx
+			r = rMap[numpy.frombuffer(r, dtype=numpy.int32)]
+			g = gMap[numpy.frombuffer(g, dtype=numpy.int32)]
+			builder.extend(r, g, numpy.frombuffer(score, dtype=numpy.dtype(scoreType)))
+			if lineIndex is not None:
+				lineIndex.extend(numpy.frombuffer(lineNo, dtype=numpy.uint32)+lineOffset, r, g,
+					numpy.zeros(len(r), dtype=numpy.int8))
+			lineOffset += nLines
+	finally:
+		pool.close()
+		pool.join()
+	del h_refId, h_readId
+	if stats is not None:
+		stats['lines'] = lineOffset
+	if lineIndex is not None and len(lineIndex):
+		# first kept line of every read, over the whole file
+		_, firstLine = numpy.unique(numpy.frombuffer(lineIndex.rIdx, dtype=numpy.int32),
+			return_index=True)
+		first = numpy.zeros(len(lineIndex), dtype=numpy.int8)
+		first[firstLine] = 1
+		lineIndex.first = pathoscope_reader.array('b', first.tostring())
+	(U, NU) = builder.build(len(read), len(genomes), collapse)
+	return U, NU, genomes, read
+
+# ===========================================================
+# With profileOut, the wall/cpu time, peak RSS and counts of every stage
+# (parse, initial best hit, EM, final best hit, report, realignment) are
+# written to a json sidecar next to the report (pathoscope_profile).
+# With emPrune, genomes without unique reads are dropped from the EM once
+# their pi falls below emPrune (pathoscope_em_pruned); they stay in the
+# reports with a final guess of 0 and are listed, with the iteration and
+# guess at which they were dropped, in <expTag>-<format>-pruned.tsv
+# ===========================================================
+def pathoscope_reassign(out_matrix, verbose, scoreCutoff, expTag, ali_format, ali_file, outdir, emEpsilon, maxIter, upalign,
+	emEngine='python', compact=False, singlePass=False, emAccel=None, emTrace=None, collapse=False,
+	compressOut=False, columnarOut=None, refIndex=None, nProc=1, profileOut=False, emPrune=None):
 	
 	if ali_format == 'gnu-sam':
 		aliFormat = 0
@@ -140,23 +205,221 @@ def pathoscope_reassign(out_matrix, verbose, scoreCutoff, expTag, ali_format, al
 	else:
 		print "unknown alignment format file..."
 		return
-	(U, NU, genomes, read) = conv_align2GRmat(ali_file,scoreCutoff,aliFormat)
-	
-	nG = len(genomes)
-	nR = len(read)
-	if verbose:
-		print "EM iteration..."
-		print "(G,R)=%dx%d" % (nG, nR)
+	if emAccel is not None and emEngine != 'numpy':
+		raise ValueError("emAccel requires emEngine='numpy'")
+	if emAccel is not None and emPrune is not None:
+		raise ValueError("EM pruning cannot be combined with EM acceleration")
+	if columnarOut is not None and columnarOut not in pathoscope_report.FORMATS:
+		raise ValueError("unknown columnar report format: %s" % columnarOut)
+	profile = pathoscope_profile.Profile(expTag=expTag, aliFormat=ali_format, emEngine=emEngine,
+		emAccel=emAccel, compact=compact or collapse, collapse=collapse, nProc=nProc,
+		aliFile=ali_file if isinstance(ali_file, basestring) else None)
+	parseStats = {} if profileOut else None
+	st = profile.begin('parse')
+	lineIndex = None
+	if upalign and singlePass:
+		# remember where every kept alignment is so rewrite_align need not reparse
+		lineIndex = pathoscope_reader.AlignLineIndex()
+	aliStream = ali_file
+	spoolFile = spool = None
+	if not isinstance(ali_file, basestring):
+		# ali_file is a stream (e.g. bowtie2 stdout) that can only be read
+		# once: keep a gzip copy of it for rewrite_align
+		ali_file = None
+		if upalign:
+			pathoscope_util.ensure_dir(outdir)
+			# a unique name, so the copy never clobbers an alignment in outdir
+			(fd, spoolFile) = tempfile.mkstemp(suffix='.' + ali_format + '.gz', dir=outdir)
+			os.close(fd)
+			spool = pathoscope_util.open_file(spoolFile,'w')
+			aliStream = pathoscope_util.tee_lines(aliStream, spool)
+	try:
+		if nProc > 1 and isinstance(aliStream, basestring) and not pathoscope_util.is_compressed(aliStream):
+			(U, NU, genomes, read) = conv_align2GRmat_sharded(aliStream,scoreCutoff,aliFormat,nProc,lineIndex,
+				collapse,parseStats)
+		else:
+			(U, NU, genomes, read) = conv_align2GRmat(aliStream,scoreCutoff,aliFormat,compact,lineIndex,collapse,
+				parseStats)
+		refIds = None
+		if refIndex is not None:
+			# global ids of the genomes of this sample; the names become the
+			# index's shared strings
+			refIds = refIndex.ref_ids(genomes)
+			genomes = [refIndex.names[k] for k in refIds]
 	
-	if out_matrix:
+		nG = len(genomes)
+		nR = len(read)
+		st.update(parseStats or {}, nR=nR, nG=nG, nU=len(U), nNU=len(NU))
 		if verbose:
-			print "writing initial alignment ..."
-		out_initial_align_matrix(genomes, read, U, NU, expTag, ali_file, outdir)	
+			print "EM iteration..."
+			print "(G,R)=%dx%d" % (nG, nR)
+	
+		if out_matrix:
+			if verbose:
+				print "writing initial alignment ..."
+			out_initial_align_matrix(genomes, read, U, NU, expTag, ali_file, outdir)	
 
-	(bestHitInitialReads, bestHitInitial, level1Initial, level2Initial) = \
-		computeBestHit(U, NU, genomes, read)
+		profile.begin('initialBestHit')
+		mat = None
+		if numpy is not None:
+			# packed once for both best hit passes and the numpy EM
+			mat = pathoscope_matrix.pack_nu(NU)
+		(bestHitInitialReads, bestHitInitial, level1Initial, level2Initial) = \
+			computeBestHit(U, NU, genomes, read, mat)
 	
-	(initPi, pi, _, NU) = pathoscope_em(U, NU, genomes, maxIter, emEpsilon, verbose)
+		emStats = profile.begin('em', prune=emPrune)
+		pruned = None if emPrune is None else []
+		if emEngine == 'numpy':
+			(initPi, pi, _, NU) = pathoscope_em_numpy(U, NU, genomes, maxIter, emEpsilon, verbose,
+				emAccel, emTrace, mat, emStats, emPrune, pruned)
+		else:
+			(initPi, pi, _, NU) = pathoscope_em(U, NU, genomes, maxIter, emEpsilon, verbose, emTrace, emStats,
+				emPrune, pruned)
+			if mat is not None:
+				pathoscope_matrix.pack_x(mat, NU)
+		if pruned is not None:
+			out_pruned(pruned, genomes, expTag, ali_format, outdir)
+		profile.begin('finalBestHit')
+		(finalReport, x1, x2, x3, x4, x5, x6, x7, x8, x9, x10, x11) = \
+			out_results(out_matrix, expTag, ali_format, outdir, U, NU, mat, genomes, read, initPi, pi,
+				(bestHitInitialReads, bestHitInitial, level1Initial, level2Initial), columnarOut, refIds,
+				profile)
+
+		reAlignfile = ali_file
+		if upalign:
+			profile.begin('realign', compress=compressOut)
+			# a stream keeps the name it had before: updated_<expTag>.<ali_format>
+			aliName = expTag + '.' + ali_format if spoolFile is not None else None
+			reAlignfile = rewrite_align(U, NU, spoolFile or ali_file,scoreCutoff, aliFormat,outdir,lineIndex,
+				compressOut, aliName)
+	finally:
+		# the gzip copy of a stream is only needed by rewrite_align: never
+		# leave it behind, even when the reassignment fails
+		if spoolFile is not None:
+			spool.close()
+			if os.path.exists(spoolFile):
+				os.remove(spoolFile)
+	if profileOut:
+		profile.write(pathoscope_profile.profile_path(outdir, expTag, ali_format))
+
+	return (finalReport, x2, x3, x4, x5, x1, x6, x7, x8, x9, x10, x11, reAlignfile)
+
+# ===========================================================
+# Joint mode for many samples aligned against the same references: every
+# sample is parsed into its own packed matrix and the per-sample EMs run
+# together in one batched numpy loop (em_joint). Each sample gets the
+# outputs pathoscope_reassign would give it (in its outdir, tagged by its
+# expTag); the combined samples x genomes matrix of final guesses is
+# returned with the genomes (the references of refIndex if given, else
+# all genomes seen, in order of appearance). With profileOut every sample
+# gets its profile sidecar; its 'em' stage is the joint EM, timed once for
+# all the samples, with the sample's own iterations and delta
+# ===========================================================
+def pathoscope_reassign_joint(out_matrix, verbose, scoreCutoff, expTags, ali_format, ali_files, outdirs,
+	emEpsilon, maxIter, upalign, collapse=False, compressOut=False, columnarOut=None, refIndex=None,
+	emTrace=None, profileOut=False):
+	pathoscope_matrix.require_numpy("pathoscope_reassign_joint")
+	aliFormat = {'gnu-sam': 0, 'sam': 1, 'bl8': 2}.get(ali_format)
+	if aliFormat is None:
+		raise ValueError("unknown alignment format: %s" % ali_format)
+	if columnarOut is not None and columnarOut not in pathoscope_report.FORMATS:
+		raise ValueError("unknown columnar report format: %s" % columnarOut)
+	if not len(expTags) == len(ali_files) == len(outdirs):
+		raise ValueError("expTags, ali_files and outdirs differ in length")
+
+	samples = []
+	for (expTag, ali_file, outdir) in zip(expTags, ali_files, outdirs):
+		if verbose:
+			print "parsing %s..." % ali_file
+		profile = pathoscope_profile.Profile(expTag=expTag, aliFormat=ali_format, emEngine='joint',
+			compact=True, collapse=collapse, aliFile=ali_file)
+		parseStats = {} if profileOut else None
+		st = profile.begin('parse')
+		lineIndex = pathoscope_reader.AlignLineIndex() if upalign else None
+		(U, NU, genomes, read) = conv_align2GRmat(ali_file,scoreCutoff,aliFormat,True,lineIndex,collapse,
+			parseStats)
+		refIds = None
+		if refIndex is not None:
+			refIds = refIndex.ref_ids(genomes)
+			genomes = [refIndex.names[k] for k in refIds]
+		st.update(parseStats or {}, nR=len(read), nG=len(genomes), nU=len(U), nNU=len(NU))
+		if out_matrix:
+			out_initial_align_matrix(genomes, read, U, NU, expTag, ali_file, outdir)
+		profile.begin('initialBestHit')
+		mat = pathoscope_matrix.pack_nu(NU)
+		initial = computeBestHit(U, NU, genomes, read, mat)
+		pisum0 = numpy.bincount(u_genomes(U), minlength=len(genomes)).astype(numpy.float64)
+		profile.end()
+		samples.append((expTag, ali_file, outdir, U, NU, genomes, read, refIds, lineIndex, initial,
+			profile, (pisum0, len(U), mat)))
+
+	if verbose:
+		print "joint EM iteration over %d samples..." % len(samples)
+	jointProfile = pathoscope_profile.Profile()
+	# every sample's sidecar gets this record: 'shared' identifies the run
+	emRec = jointProfile.begin('em', joint=True, shared=uuid.uuid4().hex, samples=len(samples))
+	emStats = [{} for _ in samples]
+	piList = em_joint([z[-1] for z in samples], maxIter, emEpsilon, verbose, emTrace, emStats)
+	jointProfile.end()
+
+	results = []
+	h_genome = {} if refIndex is None else refIndex.h_refId
+	allGenomes = [] if refIndex is None else refIndex.names
+	cols = []
+	for ((expTag, ali_file, outdir, U, NU, genomes, read, refIds, lineIndex, initial, profile, (_, _, mat)),
+		(initPi, pi, _), sampleEmStats) in zip(samples, piList, emStats):
+		if not genomes:
+			# nothing aligned: no report, as pathoscope_reassign cannot make one either
+			results.append(None)
+			cols.append(([], []))
+			continue
+		profile.add(dict(emRec, **sampleEmStats))
+		initPi = initPi.tolist()
+		pi = pi.tolist()
+		profile.begin('finalBestHit')
+		(finalReport, x1, x2, x3, x4, x5, x6, x7, x8, x9, x10, x11) = \
+			out_results(out_matrix, expTag, ali_format, outdir, U, NU, mat, genomes, read, initPi, pi,
+				initial, columnarOut, refIds, profile)
+		reAlignfile = ali_file
+		if upalign:
+			profile.begin('realign', compress=compressOut)
+			reAlignfile = rewrite_align(U, NU, ali_file, scoreCutoff, aliFormat, outdir, lineIndex,
+				compressOut)
+		if profileOut:
+			profile.write(pathoscope_profile.profile_path(outdir, expTag, ali_format))
+		results.append((finalReport, x2, x3, x4, x5, x1, x6, x7, x8, x9, x10, x11, reAlignfile))
+		if refIds is None:
+			refIds = []
+			for g in genomes:
+				k = h_genome.get(g, -1)
+				if k == -1:
+					k = h_genome[g] = len(allGenomes)
+					allGenomes.append(g)
+				refIds.append(k)
+		cols.append((refIds, pi))
+
+	matrix = numpy.zeros((len(samples), len(allGenomes)))
+	for (s, (refIds, pi)) in enumerate(cols):
+		matrix[s, refIds] = pi
+	return results, allGenomes, matrix
+
+# ===========================================================
+# genomes dropped by EM pruning: name, iteration and guess when dropped
+def out_pruned(pruned, genomes, expTag, ali_format, outdir):
+	prunedFile = outdir + os.sep + expTag + '-' + ali_format + '-pruned.tsv'
+	oFp = open(prunedFile,'wb')
+	csv_writer = csv.writer(oFp, delimiter='\t')
+	csv_writer.writerow(['Genome', 'Pruned At Iteration', 'Guess When Pruned'])
+	csv_writer.writerows([(genomes[k], i, p) for (k, i, p) in pruned])
+	oFp.close()
+	return prunedFile
+
+# ===========================================================
+# Guess files, report tsv and columnar report from the EM results;
+# initial holds the computeBestHit results from before the EM
+# ===========================================================
+def out_results(out_matrix, expTag, ali_format, outdir, U, NU, mat, genomes, read, initPi, pi, initial,
+	columnarOut=None, refIds=None, profile=None):
 	tmp = zip(initPi,genomes)
 	tmp = sorted(tmp,reverse=True) #similar to sort row
 	
@@ -169,8 +432,11 @@ def pathoscope_reassign(out_matrix, verbose, scoreCutoff, expTag, ali_format, al
 	
 	del tmp
 	
+	(bestHitInitialReads, bestHitInitial, level1Initial, level2Initial) = initial
 	(bestHitFinalReads, bestHitFinal, level1Final, level2Final) = \
-		computeBestHit(U, NU, genomes, read)
+		computeBestHit(U, NU, genomes, read, mat)
+	if profile is not None:
+		profile.begin('report', columnar=columnarOut)
 
 	if out_matrix:
 		finalGuess = outdir + os.sep + expTag + '-finGuess.txt'
@@ -182,6 +448,8 @@ def pathoscope_reassign(out_matrix, verbose, scoreCutoff, expTag, ali_format, al
 		oFp.close()
 
 	finalReport = outdir + os.sep + expTag +'-'+ ali_format + '-report.tsv'
+	nG = len(genomes)
+	nR = len(read)
 	oFp = open(finalReport,'wb')
 	tmp = zip(pi,genomes, initPi, bestHitInitial, bestHitInitialReads, bestHitFinal, bestHitFinalReads, \
 		level1Initial, level2Initial, level1Final, level2Final)
@@ -202,17 +470,25 @@ def pathoscope_reassign(out_matrix, verbose, scoreCutoff, expTag, ali_format, al
 	csv_writer.writerow(header)
 	csv_writer.writerows(tmp)
 	oFp.close()
-	
-	reAlignfile = ali_file
-	if upalign:
-		reAlignfile = rewrite_align(U, NU, ali_file,scoreCutoff, aliFormat,outdir)
 
-	return (finalReport, x2, x3, x4, x5, x1, x6, x7, x8, x9, x10, x11, reAlignfile)
+	if columnarOut is not None:
+		# same report, all genomes in index order, for loading without text parsing
+		columns = dict(zip(pathoscope_report.REPORT_COLUMNS, [pi, bestHitFinal, bestHitFinalReads,
+			level1Final, level2Final, initPi, bestHitInitial, bestHitInitialReads, level1Initial,
+			level2Initial]))
+		pathoscope_report.write_report(pathoscope_report.report_path(outdir, expTag, ali_format,
+			columnarOut), columnarOut, genomes, nR, columns, refIds)
+
+	return (finalReport, x1, x2, x3, x4, x5, x6, x7, x8, x9, x10, x11)
 
 # ===========================================================
 # This is the main EM algorithm
 # ===========================================================
-def pathoscope_em(U, NU, genomes, maxIter, emEpsilon, verbose):
+def pathoscope_em(U, NU, genomes, maxIter, emEpsilon, verbose, emTrace=None, emStats=None, prune=None,
+	pruned=None):
+	if prune is not None:
+		return pathoscope_em_pruned(U, NU, genomes, maxIter, emEpsilon, verbose, prune, emTrace, emStats,
+			pruned)
 	G = len(genomes)
 
 	### Initial values
@@ -271,11 +547,447 @@ def pathoscope_em(U, NU, genomes, maxIter, emEpsilon, verbose):
 			cutoff += abs(pi_old[k]-pi[k])
 		if verbose:
 			print "[%d]%g" % (i,cutoff)
+		if emTrace is not None:
+			emTrace.append({'iter': i, 'steps': i+1, 'delta': cutoff})
+		if emStats is not None:
+			emStats.update(iterations=i+1, steps=i+1, delta=cutoff, converged=cutoff <= emEpsilon)
 		if (cutoff <= emEpsilon or lenNU==1):
 			break
 
 	return initPi, pi, theta, NU
 
+# ===========================================================
+# pathoscope_em with pruning: after every iteration that has not
+# converged, genomes without unique reads whose pi fell below prune are
+# taken out of the EM (their pi and theta set to 0) and the NU reads
+# aligned to them go on with their other genomes only, so later E steps
+# skip them. A genome stays in while some read has no other genome left.
+# The final xij of a pruned alignment is 0. Until the first genome is
+# pruned, the iterations are exactly those of pathoscope_em. pruned (a
+# list) gets (gIdx, iteration, pi) for every genome taken out
+# ===========================================================
+def pathoscope_em_pruned(U, NU, genomes, maxIter, emEpsilon, verbose, prune, emTrace=None, emStats=None,
+	pruned=None):
+	G = len(genomes)
+	pi = [1./G for _ in genomes]
+	initPi = pi
+	theta = [1./G for _ in genomes]
+	pisum0=[0 for i in genomes]
+	for i in U:
+		pisum0[U[i]]+=1
+	lenNU=len(NU)
+	if lenNU==0:
+		lenNU=1
+	prunable = [k == 0 for k in pisum0]
+	# per NU read: genomes still in play, their scores and their positions
+	# in NU[j] (None while it has all of them)
+	work = dict((j, (NU[j][0], NU[j][1], None)) for j in NU)
+	xPart = {}
+	rowsOf = None
+	nPruned = 0
+
+	for i in range(maxIter):
+		pi_old = pi
+		thetasum=[0 for k in genomes]
+
+		# E Step (the same arithmetic as in pathoscope_em)
+		for j in NU:
+			(ind, q, pos) = work[j]
+			xtmp = [pi[k]*theta[k]*qk for (k, qk) in zip(ind, q)]
+			xsum = sum(xtmp)
+			xnorm = [x/xsum for x in xtmp]
+			if pos is None:
+				NU[j][2] = xnorm
+			else:
+				xPart[j] = xnorm
+			for (k, x) in zip(ind, xnorm):
+				thetasum[k] += x
+		# M step
+		pisum = [thetasum[k]+pisum0[k] for k in range(len(thetasum))]
+		pi = [1.*k/(len(U)+len(NU)) for k in pisum]
+		if (i == 0):
+			initPi = pi
+		theta = [1.*k/lenNU for k in thetasum]
+
+		cutoff = 0.0
+		for k in range(len(pi)):
+			cutoff += abs(pi_old[k]-pi[k])
+		if verbose:
+			print "[%d]%g (%d pruned)" % (i,cutoff,nPruned)
+		if emTrace is not None:
+			emTrace.append({'iter': i, 'steps': i+1, 'delta': cutoff, 'pruned': nPruned})
+		if emStats is not None:
+			emStats.update(iterations=i+1, steps=i+1, delta=cutoff, converged=cutoff <= emEpsilon,
+				pruned=nPruned)
+		if (cutoff <= emEpsilon or lenNU==1 or i == maxIter-1):
+			break
+
+		drop = set(k for k in range(G) if prunable[k] and pi[k] < prune)
+		if not drop:
+			continue
+		if rowsOf is None:
+			# NU reads of every genome
+			rowsOf = [[] for _ in genomes]
+			for j in NU:
+				for k in NU[j][0]:
+					rowsOf[k].append(j)
+		affected = set()
+		for k in drop:
+			affected.update(rowsOf[k])
+		# a read keeps its genomes when it would have none left
+		kept = set()
+		for j in affected:
+			ind = work[j][0]
+			if all(k in drop for k in ind):
+				kept.update(ind)
+		drop -= kept
+		if not drop:
+			continue
+		for j in affected:
+			(ind, q, pos) = work[j]
+			if not any(k in drop for k in ind):
+				continue
+			if pos is None:
+				pos = range(len(ind))
+			keep = [k for k in range(len(ind)) if ind[k] not in drop]
+			work[j] = ([ind[k] for k in keep], [q[k] for k in keep], [pos[k] for k in keep])
+		pi = list(pi)
+		for k in sorted(drop):
+			if pruned is not None:
+				pruned.append((k, i, pi[k]))
+			pi[k] = 0.0
+			theta[k] = 0.0
+			prunable[k] = False
+		nPruned += len(drop)
+
+	# full xij of the reads that lost genomes
+	for (j, xnorm) in xPart.iteritems():
+		x = [0.0]*len(NU[j][0])
+		for (k, p) in enumerate(work[j][2]):
+			x[p] = xnorm[k]
+		NU[j][2] = x
+	return initPi, pi, theta, NU
+
+# ===========================================================
+# Same EM as pathoscope_em, with NU packed into CSR arrays and each
+# iteration done as batched numpy operations. initPi, pi, theta and the
+# updated NU agree with pathoscope_em to within 1e-12 (only the order of
+# the floating point sums differs)
+# ===========================================================
+def pathoscope_em_numpy(U, NU, genomes, maxIter, emEpsilon, verbose, accel=None, emTrace=None,
+	mat=None, emStats=None, prune=None, pruned=None):
+	pathoscope_matrix.require_numpy("pathoscope_em_numpy")
+	G = len(genomes)
+	if mat is None:
+		mat = pathoscope_matrix.pack_nu(NU)
+	pisum0 = numpy.bincount(u_genomes(U), minlength=G).astype(numpy.float64)
+	(initPi, pi, theta) = em_packed(pisum0, len(U), mat, G, maxIter, emEpsilon, verbose, accel, emTrace,
+		emStats, prune, pruned)
+	pathoscope_matrix.unpack_x(mat, NU)
+	return initPi.tolist(), pi.tolist(), theta.tolist(), NU
+
+# genome index of every uniquely aligned read
+def u_genomes(U):
+	if isinstance(U, pathoscope_matrix.UView):
+		return U.genomes()
+	return numpy.fromiter(U.itervalues(), dtype=numpy.int64, count=len(U))
+
+# accel='squarem' extrapolates along the last two EM steps (SQUAREM, scheme
+# S3 of Varadhan & Roland 2008) and falls back to the plain double EM step
+# whenever the extrapolated point lowers the log likelihood
+#   sum_U log(pi_g) + sum_NU log(sum_j pi_j*theta_j*q_j)
+# maxIter counts EM steps in both modes. If emTrace is a list, one dict per
+# iteration (iter, steps, delta, loglik and, for squarem, alpha) is
+# appended to it. If emStats is a dict, it gets the number of iterations
+# and steps, the last delta and whether that is within emEpsilon. prune
+# and pruned are as for pathoscope_em_pruned (not with squarem)
+def em_packed(pisum0, nU, mat, G, maxIter, emEpsilon, verbose, accel=None, emTrace=None, emStats=None,
+	prune=None, pruned=None):
+	if prune is not None:
+		if accel is not None:
+			raise ValueError("EM pruning cannot be combined with EM acceleration")
+		return em_packed_pruned(pisum0, nU, mat, G, maxIter, emEpsilon, verbose, prune, emTrace,
+			emStats, pruned)
+	nRows = len(mat)
+	nNU = mat.n_reads()
+	lenNU = nNU
+	if lenNU == 0:
+		lenNU = 1
+	pi = numpy.repeat(1./G, G)
+	initPi = pi
+	theta = numpy.repeat(1./G, G)
+
+	gIdx = mat.gIdx
+	q = mat.score
+	rowOf = mat.row_of_entry()
+	# rows of a collapsed matrix count for all the reads of their class
+	weight = mat.weight
+	entryWeight = None if weight is None else weight[rowOf]
+	nPi = nU+nNU
+	def step(pi, theta):
+		# E Step
+		xtmp = pi[gIdx]*theta[gIdx]*q
+		xsum = numpy.bincount(rowOf, weights=xtmp, minlength=nRows)
+		xnorm = xtmp/xsum[rowOf]
+		if entryWeight is None:
+			thetasum = numpy.bincount(gIdx, weights=xnorm, minlength=G)
+		else:
+			thetasum = numpy.bincount(gIdx, weights=xnorm*entryWeight, minlength=G)
+		# M step
+		return (thetasum+pisum0)/nPi, thetasum/lenNU, xnorm
+	def loglik(pi, theta):
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			ll = (pisum0[pisum0 > 0]*numpy.log(pi[pisum0 > 0])).sum()
+			xsum = numpy.bincount(rowOf, weights=pi[gIdx]*theta[gIdx]*q, minlength=nRows)
+			if weight is None:
+				ll += numpy.log(xsum).sum()
+			else:
+				ll += (weight*numpy.log(xsum)).sum()
+		return ll if numpy.isfinite(ll) else -numpy.inf
+
+	if accel is None:
+		for i in range(maxIter):  ## EM iterations
+			pi_old = pi
+			(pi, theta, mat.x) = step(pi, theta)
+			if (i == 0):
+				initPi = pi
+			cutoff = numpy.abs(pi_old-pi).sum()
+			if verbose:
+				print "[%d]%g" % (i,cutoff)
+			if emTrace is not None:
+				emTrace.append({'iter': i, 'steps': i+1, 'delta': cutoff, 'loglik': loglik(pi, theta)})
+			if emStats is not None:
+				emStats.update(iterations=i+1, steps=i+1, delta=float(cutoff),
+					converged=bool(cutoff <= emEpsilon))
+			if (cutoff <= emEpsilon or lenNU==1):
+				break
+		return initPi, pi, theta
+	elif accel != 'squarem':
+		raise ValueError("unknown EM acceleration: %s" % accel)
+
+	nSteps = 0
+	i = 0
+	while nSteps < maxIter:
+		(pi1, theta1, mat.x) = step(pi, theta)
+		if nSteps == 0:
+			initPi = pi1
+		nSteps += 1
+		if lenNU == 1 or nSteps == maxIter or numpy.abs(pi1-pi).sum() <= emEpsilon:
+			(cutoff, alpha, pi, theta) = (numpy.abs(pi1-pi).sum(), 1.0, pi1, theta1)
+		else:
+			(pi2, theta2, x2) = step(pi1, theta1)
+			nSteps += 1
+			r = numpy.concatenate((pi1-pi, theta1-theta))
+			v = numpy.concatenate((pi2-pi1, theta2-theta1))-r
+			vnorm = numpy.sqrt((v*v).sum())
+			alpha = -numpy.sqrt((r*r).sum())/vnorm if vnorm > 0 else -1.0
+			alpha = min(alpha, -1.0)
+			# extrapolate, project back onto the simplex and stabilise with one EM step
+			piX = numpy.clip(pi-2*alpha*r[:G]+alpha*alpha*v[:G], 0, None)
+			thetaX = numpy.clip(theta-2*alpha*r[G:]+alpha*alpha*v[G:], 0, None)
+			accepted = alpha < -1.0 and piX.sum() > 0 and thetaX.sum() > 0 and nSteps < maxIter
+			if accepted:
+				piX /= piX.sum()
+				thetaX /= thetaX.sum()
+				accepted = loglik(piX, thetaX) >= loglik(pi2, theta2)
+			if accepted:
+				(pi3, theta3, x3) = step(piX, thetaX)
+				nSteps += 1
+				(cutoff, pi, theta, mat.x) = (numpy.abs(pi3-piX).sum(), pi3, theta3, x3)
+			else:
+				alpha = -1.0
+				(cutoff, pi, theta, mat.x) = (numpy.abs(pi2-pi1).sum(), pi2, theta2, x2)
+		if verbose:
+			print "[%d]%g" % (i,cutoff)
+		if emTrace is not None:
+			emTrace.append({'iter': i, 'steps': nSteps, 'delta': cutoff, 'loglik': loglik(pi, theta),
+				'alpha': float(alpha)})
+		if emStats is not None:
+			emStats.update(iterations=i+1, steps=nSteps, delta=float(cutoff),
+				converged=bool(cutoff <= emEpsilon))
+		i += 1
+		if (cutoff <= emEpsilon or lenNU==1):
+			break
+
+	return initPi, pi, theta
+
+# em_packed with pruning (see pathoscope_em_pruned): the entries of pruned
+# genomes are dropped from the packed arrays, so every later E step works
+# on the remaining entries only
+def em_packed_pruned(pisum0, nU, mat, G, maxIter, emEpsilon, verbose, prune, emTrace=None, emStats=None,
+	pruned=None):
+	nRows = len(mat)
+	nNU = mat.n_reads()
+	lenNU = nNU
+	if lenNU == 0:
+		lenNU = 1
+	pi = numpy.repeat(1./G, G)
+	initPi = pi
+	theta = numpy.repeat(1./G, G)
+	nPi = nU+nNU
+
+	# entries still in play: their positions in mat and their arrays
+	live = numpy.arange(len(mat.gIdx))
+	gIdx = mat.gIdx
+	q = mat.score
+	rowOf = mat.row_of_entry()
+	entryWeight = None if mat.weight is None else mat.weight[rowOf]
+	prunable = pisum0 == 0
+	nPruned = 0
+	xnorm = None
+	for i in range(maxIter):
+		pi_old = pi
+		# E Step
+		xtmp = pi[gIdx]*theta[gIdx]*q
+		xsum = numpy.bincount(rowOf, weights=xtmp, minlength=nRows)
+		xnorm = xtmp/xsum[rowOf]
+		if entryWeight is None:
+			thetasum = numpy.bincount(gIdx, weights=xnorm, minlength=G)
+		else:
+			thetasum = numpy.bincount(gIdx, weights=xnorm*entryWeight, minlength=G)
+		# M step
+		pi = (thetasum+pisum0)/nPi
+		theta = thetasum/lenNU
+		if (i == 0):
+			initPi = pi
+		cutoff = numpy.abs(pi_old-pi).sum()
+		if verbose:
+			print "[%d]%g (%d pruned)" % (i,cutoff,nPruned)
+		if emTrace is not None:
+			emTrace.append({'iter': i, 'steps': i+1, 'delta': cutoff, 'pruned': nPruned,
+				'entries': len(live)})
+		if emStats is not None:
+			emStats.update(iterations=i+1, steps=i+1, delta=float(cutoff),
+				converged=bool(cutoff <= emEpsilon), pruned=nPruned)
+		if (cutoff <= emEpsilon or lenNU==1 or i == maxIter-1):
+			break
+
+		drop = prunable & (pi < prune)
+		if not drop.any():
+			continue
+		keep = ~drop[gIdx]
+		# a read keeps its genomes when it would have none left
+		emptied = numpy.bincount(rowOf, weights=keep, minlength=nRows) == 0
+		if emptied.any():
+			drop[gIdx[emptied[rowOf]]] = False
+			keep = ~drop[gIdx]
+		dropped = numpy.flatnonzero(drop)
+		if len(dropped) == 0:
+			continue
+		if pruned is not None:
+			pruned.extend(zip(dropped.tolist(), [i]*len(dropped), pi[dropped].tolist()))
+		pi = numpy.where(drop, 0.0, pi)
+		theta = numpy.where(drop, 0.0, theta)
+		prunable &= ~drop
+		nPruned += len(dropped)
+		live = live[keep]
+		gIdx = gIdx[keep]
+		q = q[keep]
+		rowOf = rowOf[keep]
+		if entryWeight is not None:
+			entryWeight = entryWeight[keep]
+		xnorm = xnorm[keep]
+
+	if xnorm is not None:
+		mat.x = numpy.zeros(len(mat.gIdx))
+		mat.x[live] = xnorm
+	return initPi, pi, theta
+
+# em_packed for many samples at once. blocks holds (pisum0, nU, mat) per
+# sample; their genomes are laid end to end in one vector of "slots" and
+# their matrix rows stacked, so one E/M step is a handful of bincounts over
+# all samples. Every sample keeps its own pi, theta, initPi and stopping
+# rule, and gets the pi/theta/x em_packed would give it. Samples that have
+# stopped are still stepped along (they do not affect the others) until
+# fewer than half of the stacked samples are running, then the arrays are
+# rebuilt without them. Returns [(initPi, pi, theta)] and leaves the final
+# x in each mat. emTrace (a list) gets one dict per iteration with the
+# number of samples still running and their largest delta; emStats (a list
+# of dicts, one per block) gets the em_packed emStats of every sample
+def em_joint(blocks, maxIter, emEpsilon, verbose, emTrace=None, emStats=None):
+	S = len(blocks)
+	nG = numpy.array([len(p) for (p, _, _) in blocks], dtype=numpy.int64)
+	nNU = numpy.array([mat.n_reads() for (_, _, mat) in blocks], dtype=numpy.float64)
+	nPi = numpy.array([nU for (_, nU, _) in blocks], dtype=numpy.float64)+nNU
+	lenNU = numpy.where(nNU == 0, 1, nNU)
+	results = [(numpy.zeros(0), numpy.zeros(0), numpy.zeros(0))]*S
+	initPi = [None]*S
+
+	def stack(stacked):
+		# slots, rows and entries of the stacked samples, end to end
+		mats = [blocks[s][2] for s in stacked]
+		gOff = numpy.zeros(len(stacked)+1, dtype=numpy.int64)
+		numpy.cumsum(nG[stacked], out=gOff[1:])
+		rOff = numpy.cumsum([0]+[len(m) for m in mats])
+		eOff = numpy.cumsum([0]+[len(m.gIdx) for m in mats])
+		slot = numpy.concatenate([m.gIdx+gOff[k] for (k, m) in enumerate(mats)])
+		rowOf = numpy.concatenate([m.row_of_entry()+rOff[k] for (k, m) in enumerate(mats)])
+		q = numpy.concatenate([m.score for m in mats]).astype(numpy.float64)
+		entryWeight = None
+		if any(m.weight is not None for m in mats):
+			entryWeight = numpy.concatenate([numpy.ones(len(m.gIdx)) if m.weight is None
+				else m.weight[m.row_of_entry()] for m in mats])
+		pisum0 = numpy.concatenate([blocks[s][0] for s in stacked])
+		slotSample = numpy.repeat(stacked, nG[stacked])
+		return (gOff, rOff[-1], eOff, slot, rowOf, q, entryWeight, pisum0, nPi[slotSample],
+			lenNU[slotSample])
+
+	# a sample without genomes has nothing to estimate
+	stacked = numpy.flatnonzero(nG > 0)
+	if len(stacked) == 0:
+		return results
+	for s in stacked:
+		initPi[s] = numpy.repeat(1./nG[s], nG[s])
+		results[s] = (initPi[s], initPi[s], initPi[s])
+	pi = numpy.concatenate([initPi[s] for s in stacked])
+	theta = pi.copy()
+	running = numpy.ones(len(stacked), dtype=bool)
+	(gOff, nRows, eOff, slot, rowOf, q, entryWeight, pisum0, slotPi, slotLenNU) = stack(stacked)
+	for i in range(maxIter):
+		pi_old = pi
+		# E Step
+		xtmp = pi[slot]*theta[slot]*q
+		xsum = numpy.bincount(rowOf, weights=xtmp, minlength=nRows)
+		xnorm = xtmp/xsum[rowOf]
+		if entryWeight is None:
+			thetasum = numpy.bincount(slot, weights=xnorm, minlength=len(pi))
+		else:
+			thetasum = numpy.bincount(slot, weights=xnorm*entryWeight, minlength=len(pi))
+		# M step
+		pi = (thetasum+pisum0)/slotPi
+		theta = thetasum/slotLenNU
+		cutoff = numpy.add.reduceat(numpy.abs(pi_old-pi), gOff[:-1])
+		if (i == 0):
+			for (k, s) in enumerate(stacked):
+				initPi[s] = pi[gOff[k]:gOff[k+1]]
+		done = running & ((cutoff <= emEpsilon) | (lenNU[stacked] == 1))
+		if i == maxIter-1:
+			done = running
+		if verbose:
+			print "[%d]%d samples, max %g" % (i, running.sum(), cutoff[running].max())
+		if emTrace is not None:
+			emTrace.append({'iter': i, 'active': int(running.sum()), 'delta': float(cutoff[running].max())})
+		if not done.any():
+			continue
+		for k in numpy.flatnonzero(done):
+			s = stacked[k]
+			results[s] = (initPi[s], pi[gOff[k]:gOff[k+1]].copy(), theta[gOff[k]:gOff[k+1]].copy())
+			blocks[s][2].x = xnorm[eOff[k]:eOff[k+1]].copy()
+			if emStats is not None:
+				emStats[s].update(iterations=i+1, steps=i+1, delta=float(cutoff[k]),
+					converged=bool(cutoff[k] <= emEpsilon))
+		running &= ~done
+		if not running.any():
+			break
+		if 2*running.sum() < len(stacked):
+			keep = numpy.flatnonzero(running)
+			pi = numpy.concatenate([pi[gOff[k]:gOff[k+1]] for k in keep])
+			theta = numpy.concatenate([theta[gOff[k]:gOff[k+1]] for k in keep])
+			stacked = stacked[keep]
+			running = running[keep]
+			(gOff, nRows, eOff, slot, rowOf, q, entryWeight, pisum0, slotPi, slotLenNU) = stack(stacked)
+	return results
+
 def out_initial_align_matrix(ref, read, U, NU, expTag, ali_file, outdir):
 	genomeId = outdir + os.sep + expTag + '-genomeId.txt'
 	oFp = open(genomeId,'wb')
@@ -289,7 +1001,11 @@ def out_initial_align_matrix(ref, read, U, NU, expTag, ali_file, outdir):
 	csv_writer.writerows([read])
 	oFp.close()
 	
-def computeBestHit(U, NU, genomes, read):
+def computeBestHit(U, NU, genomes, read, mat=None):
+	if mat is None and numpy is not None:
+		mat = pathoscope_matrix.pack_nu(NU)
+	if mat is not None:
+		return best_hit_packed(u_genomes(U), mat, len(genomes), len(read))
 	bestHitReads=[0.0 for _ in genomes]
 	level1Reads=[0.0 for _ in genomes]
 	level2Reads=[0.0 for _ in genomes]
@@ -322,125 +1038,198 @@ def computeBestHit(U, NU, genomes, read):
 	level2 = [level2Reads[k]/nR for k in range(nG)]
 	return bestHitReads, bestHit, level1, level2
 
+# computeBestHit on the packed NU matrix: the per read max, ties and
+# confidence levels become segment operations over the rows. Best hit
+# fractions are added to the unique read counts one at a time in row
+# order (numpy.add.at), as the loop above does, so the sums come out the
+# same to the last bit.
+def best_hit_packed(uGenomes, mat, G, nR):
+	bestHitReads = numpy.bincount(uGenomes, minlength=G).astype(numpy.float64)
+	level1Reads = bestHitReads.copy()
+	level2Reads = numpy.zeros(G)
+	if len(mat):
+		x = mat.x
+		rowOf = mat.row_of_entry()
+		rowMax = numpy.maximum.reduceat(x, mat.offsets[:-1])
+		best = numpy.flatnonzero(x == rowMax[rowOf])
+		bestRow = rowOf[best]
+		bestGenome = mat.gIdx[best]
+		bestX = x[best]
+		numBestGenome = numpy.bincount(bestRow, minlength=len(mat))[bestRow]
+		share = 1.0/numBestGenome
+		if mat.weight is None:
+			reads = numpy.ones(len(best))
+		else:
+			# a collapsed row stands for weight reads
+			reads = mat.weight[bestRow]
+			share *= reads
+		if (numBestGenome == 1).all() and mat.weight is None:
+			# no ties: only whole reads are added, in any order
+			bestHitReads += numpy.bincount(bestGenome, minlength=G)
+		else:
+			numpy.add.at(bestHitReads, bestGenome, share)
+		level1 = bestX >= 0.5
+		level2 = ~level1 & (bestX >= 0.01)
+		level1Reads += numpy.bincount(bestGenome[level1], weights=reads[level1], minlength=G)
+		level2Reads += numpy.bincount(bestGenome[level2], weights=reads[level2], minlength=G)
+	bestHit = bestHitReads/nR
+	level1 = level1Reads/nR
+	level2 = level2Reads/nR
+	return bestHitReads.tolist(), bestHit.tolist(), level1.tolist(), level2.tolist()
+
 # ===========================================================
-def rewrite_align(U, NU, aliDfile, pScoreCutoff, aliFormat,outdir):
+def rewrite_align(U, NU, aliDfile, pScoreCutoff, aliFormat, outdir, lineIndex=None, compress=False,
+	aliName=None):
 	pathoscope_util.ensure_dir(outdir)
-	f = os.path.basename(aliDfile)
+	f = os.path.basename(aliName or aliDfile)
+	for (ext, plain) in (('.gz', ''), ('.bgz', ''), ('.bam', '.sam')):
+		if f.endswith(ext):
+			f = f[:-len(ext)]+plain
+			break
 	reAlignfile = outdir + os.sep + 'updated_' + f
+	if compress:
+		reAlignfile += '.gz'
+
+	with pathoscope_util.open_file(reAlignfile,'w') as of:
+		with pathoscope_util.open_file(aliDfile,'r') as in1:
+			if lineIndex is not None:
+				rewrite_align_indexed(U, NU, lineIndex, in1, of, pScoreCutoff, aliFormat)
+				return reAlignfile
 
-	with open(reAlignfile,'w') as of:
-		with open(aliDfile,'r') as in1:
 			h_readId = {}
 			h_refId = {}
 			genomes = []
 			read =[]
 			gCnt = 0
 			rCnt = 0
-		
-			mxBitSc = 700
-			sigma2 = 3
-			for ln in in1:
-				if (ln[0] == '@' or ln[0] == '#'):
-					of.write(ln)
-					continue
-		
-				l = ln.split('\t')
-				
-				readId=l[0]
-				if (aliFormat == 0 or aliFormat == 1): # gnu-sam or sam
-					refId=l[2]
-				elif (aliFormat == 2): # bl8
-					refId=l[1]
-				
-				if refId == '*':
-					continue
-		
-				if (aliFormat == 0): # gnu-sam
-					pScore = float(l[12].split(':')[2])
-					if (pScore < pScoreCutoff):
-						continue
-				elif (aliFormat == 1): # sam
-					mapq = float(l[4])
-					mapq2 = mapq/(-10.0)
-					pScore = 1.0 - pow(10,mapq2)
-					if (pScore < pScoreCutoff):
-						continue
-				elif (aliFormat == 2): # bl8
-					eVal = float(l[10])
-					if (eVal > pScoreCutoff):
-						continue
-					bitSc = float(l[11])/sigma2
-					if bitSc > mxBitSc:
-						bitSc = mxBitSc
-					pScore = math.exp(bitSc)
-				pScore = int(round(pScore*100)) # Converting to integer to conserve memory space
-				if pScore < 1:
-					continue
-				
-				gIdx = h_refId.get(refId,-1)
-				if gIdx == -1:
-					gIdx = gCnt
-					h_refId[refId] = gIdx
-					genomes.append(refId)
-					gCnt += 1
-		
+
+			for (readId, alns) in pathoscope_reader.iter_read_groups(in1, aliFormat, pScoreCutoff,
+				header=of.write, warn=False):
 				rIdx = h_readId.get(readId,-1)
-				if rIdx == -1:
-					#hold on this new read
-					#first, wrap previous read profile and see if any previous read has a same profile with that!
+				newRead = (rIdx == -1)
+				if newRead:
 					rIdx = rCnt
 					h_readId[readId] = rIdx
 					read.append(readId)
 					rCnt += 1
-					if rIdx in U:
-						of.write(ln)
-						continue
-							
-				if rIdx in NU:
-					if (aliFormat == 0): # gnu-sam
-						scoreComponents = l[12].split(':')
-						pScore = float(scoreComponents[2])
-						if (pScore < pScoreCutoff):
-							continue
-						(upPscore, pscoreSum) = find_updated_score(NU, rIdx, gIdx)
-						scoreComponents[2] = str(upPscore*pscoreSum)
-						if (scoreComponents[2] < pScoreCutoff):
-							continue
-						l[12] = ':'.join(scoreComponents)
-						ln = '\t'.join(l)
-						of.write(ln)
-					elif (aliFormat == 1): # sam
-						mapq = float(l[4])
-						mapq2 = mapq/(-10.0)
-						pScore = 1.0 - pow(10,mapq2)
-						if (pScore < pScoreCutoff):
-							continue
-						(upPscore, pscoreSum) = find_updated_score(NU, rIdx, gIdx)
-						if (upPscore < pScoreCutoff):
-							continue
-						if (upPscore >= 1.0):
-							upPscore = 0.999999
-						mapq2 = math.log10(1 - upPscore)
-						l[4] = str(int(round(-10.0*mapq2)))
-						ln = '\t'.join(l)
-						of.write(ln)
-					elif (aliFormat == 2): # bl8
-						eVal = float(l[10])
-						if (eVal > pScoreCutoff):
+
+				for (refId, pScore, ln, l, _) in alns:
+					gIdx = h_refId.get(refId,-1)
+					if gIdx == -1:
+						gIdx = gCnt
+						h_refId[refId] = gIdx
+						genomes.append(refId)
+						gCnt += 1
+
+					if newRead:
+						newRead = False
+						if rIdx in U:
+							of.write(ln)
 							continue
+
+					if rIdx in NU:
 						(upPscore, pscoreSum) = find_updated_score(NU, rIdx, gIdx)
-						score = upPscore*pscoreSum
-						if score <= 0.0:
-							continue
-						bitSc = math.log(score)
-						if bitSc > mxBitSc:
-							bitSc = mxBitSc
-						l[10] = str(bitSc*sigma2)
-						ln = '\t'.join(l)
-						of.write(ln)
+						ln = update_align_line(l, upPscore, pscoreSum, pScoreCutoff, aliFormat)
+						if ln is not None:
+							of.write(ln)
 
 	return reAlignfile
 
+# Second pass driven by the AlignLineIndex recorded in conv_align2GRmat:
+# lines are matched by position only, no scoring or id hashing
+def rewrite_align_indexed(U, NU, lineIndex, in1, of, pScoreCutoff, aliFormat):
+	maxsplit = pathoscope_reader.nSplit[aliFormat]
+	nKept = len(lineIndex)
+	if numpy is not None:
+		(actions, upPscores, pscoreSums) = indexed_line_updates(U, NU, lineIndex)
+	k = 0
+	lineNo = -1
+	for ln in in1:
+		if (ln[0] == '@' or ln[0] == '#'):
+			of.write(ln)
+			continue
+		lineNo += 1
+		if k == nKept or lineNo != lineIndex.lineNo[k]:
+			continue
+		if numpy is not None:
+			action = actions[k]
+		else:
+			rIdx = lineIndex.rIdx[k]
+			action = 2 if rIdx in NU else (1 if lineIndex.first[k] and rIdx in U else 0)
+		if action == 2:
+			if numpy is not None:
+				(upPscore, pscoreSum) = (upPscores[k], pscoreSums[k])
+			else:
+				(upPscore, pscoreSum) = find_updated_score(NU, rIdx, lineIndex.gIdx[k])
+			ln = update_align_line(ln.split('\t', maxsplit), upPscore, pscoreSum, pScoreCutoff, aliFormat)
+			if ln is not None:
+				of.write(ln)
+		elif action == 1:
+			of.write(ln)
+		k += 1
+
+# For every line of lineIndex: the action of rewrite_align (2 update it,
+# 1 copy it, 0 drop it) and, for updated lines, what find_updated_score
+# would return
+def indexed_line_updates(U, NU, lineIndex):
+	mat = pathoscope_matrix.pack_nu(NU)
+	r = numpy.frombuffer(lineIndex.rIdx, dtype=numpy.int32)
+	g = numpy.frombuffer(lineIndex.gIdx, dtype=numpy.int32).astype(numpy.int64)
+	first = numpy.frombuffer(lineIndex.first, dtype=numpy.int8) != 0
+	nR = int(r.max())+1 if len(r) else 0
+	if isinstance(U, pathoscope_matrix.UView):
+		uRead = U.uRead
+	else:
+		uRead = numpy.fromiter(U.iterkeys(), dtype=numpy.int64, count=len(U))
+	isU = numpy.zeros(nR, dtype=bool)
+	isU[uRead[uRead < nR]] = True
+	if isinstance(NU, pathoscope_matrix.NUView):
+		nuRow = NU.nuRow
+	else:
+		nuRow = numpy.repeat(-1, max(nR, int(mat.nuRead.max())+1 if len(mat) else 0))
+		nuRow[mat.nuRead] = numpy.arange(len(mat))
+	row = nuRow[r]
+	isNU = row >= 0
+	actions = numpy.where(isNU, 2, numpy.where(first & isU[r], 1, 0))
+
+	upPscores = numpy.zeros(len(r))
+	pscoreSums = numpy.zeros(len(r))
+	if isNU.any():
+		nG = max(g.max(), mat.gIdx.max())+1
+		rowOf = mat.row_of_entry()
+		entryKey = rowOf*nG+mat.gIdx
+		order = numpy.argsort(entryKey, kind='mergesort')
+		entry = order[numpy.searchsorted(entryKey[order], row[isNU]*nG+g[isNU])]
+		upPscores[isNU] = mat.x[entry]
+		pscoreSum = numpy.bincount(rowOf, weights=mat.score, minlength=len(mat))/100
+		pscoreSums[isNU] = pscoreSum[row[isNU]]
+	return actions.tolist(), upPscores.tolist(), pscoreSums.tolist()
+
+# updated alignment line from its split fields l (None to drop it)
+def update_align_line(l, upPscore, pscoreSum, pScoreCutoff, aliFormat):
+	if (aliFormat == 0): # gnu-sam
+		scoreComponents = l[12].split(':')
+		scoreComponents[2] = str(upPscore*pscoreSum)
+		if (scoreComponents[2] < pScoreCutoff):
+			return None
+		l[12] = ':'.join(scoreComponents)
+	elif (aliFormat == 1): # sam
+		if (upPscore < pScoreCutoff):
+			return None
+		if (upPscore >= 1.0):
+			upPscore = 0.999999
+		mapq2 = math.log10(1 - upPscore)
+		l[4] = str(int(round(-10.0*mapq2)))
+	elif (aliFormat == 2): # bl8
+		score = upPscore*pscoreSum
+		if score <= 0.0:
+			return None
+		bitSc = math.log(score)
+		if bitSc > pathoscope_reader.mxBitSc:
+			bitSc = pathoscope_reader.mxBitSc
+		l[10] = str(bitSc*pathoscope_reader.sigma2)
+	return '\t'.join(l)
+
 def find_updated_score(NU, rIdx, gIdx):
 	index = NU[rIdx][0].index(gIdx);
 	pscoreSum = 0.0
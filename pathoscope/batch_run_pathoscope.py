@@ -14,14 +14,26 @@ Description:
 import os
 import sys
 import glob
+import json
+import time
 import shutil
+import hashlib
 import logging
 import argparse
+import traceback
 import subprocess
+import multiprocessing
 import ConfigParser
 import PathoID
-from Bio import SeqIO
-from Bio.SeqIO.QualityIO import PairedFastaQualIterator
+import pathoscope_util
+import pathoscope_report
+import pathoscope_profile
+import pathoscope_refindex
+import fasta_qual_to_fastq
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import pdb
 
@@ -40,9 +52,16 @@ def get_args():
     parser.add_argument(
             "--output",
             required=True,
-            action=CreateDir,
+            action=FullPaths,
             help="""The path to the output directory"""
         )
+    parser.add_argument(
+            "--resume",
+            action="store_true",
+            default=False,
+            help="""Keep an existing output directory and skip the stages whose
+                inputs are unchanged since they last completed."""
+        )
     parser.add_argument(
             "--reference",
             required=True,
@@ -56,6 +75,46 @@ def get_args():
             action=FullPaths,
             help="""The path to the primers to trim."""
         )
+    parser.add_argument(
+            "--cores",
+            type=int,
+            default=1,
+            help="""The total number of compute cores to use."""
+        )
+    parser.add_argument(
+            "--bowtie-threads",
+            type=int,
+            default=1,
+            help="""The number of bowtie2 threads (-p) per sample.  Samples run
+                concurrently on cores/bowtie-threads workers."""
+        )
+    parser.add_argument(
+            "--stream",
+            action="store_true",
+            default=False,
+            help="""Pipe bowtie2 output straight into pathoscope instead of writing a sam file."""
+        )
+    parser.add_argument(
+            "--joint",
+            action="store_true",
+            default=False,
+            help="""Align the samples one by one, then reassign all of them in
+                one joint (batched) EM.  Not compatible with --stream."""
+        )
+    parser.add_argument(
+            "--compress",
+            action="store_true",
+            default=False,
+            help="""Gzip the sam written by bowtie2 and the updated alignment
+                written by pathoscope."""
+        )
+    parser.add_argument(
+            "--columnar",
+            choices=["npz", "parquet"],
+            default=None,
+            help="""Also write each report in a columnar format and aggregate
+                the final guesses of all samples into one matrix."""
+        )
     parser.add_argument(
         "--log-path",
         action=FullPaths,
@@ -70,7 +129,11 @@ def get_args():
         default="INFO",
         help="""The logging level to use."""
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.joint and args.stream:
+        parser.error("--joint and --stream cannot be combined")
+    create_output_dir(args.output, args.resume)
+    return args
 
 
 class FullPaths(argparse.Action):
@@ -79,22 +142,20 @@ class FullPaths(argparse.Action):
         setattr(namespace, self.dest, os.path.abspath(os.path.expanduser(values)))
 
 
-class CreateDir(argparse.Action):
-    def __call__(self, parser, namespace, values, option_string=None):
-        # get the full path
-        d = os.path.abspath(os.path.expanduser(values))
-        # check to see if directory exists
-        if os.path.exists(d):
-            answer = raw_input("[WARNING] Output directory exists, REMOVE [Y/n]? ")
-            if answer == "Y":
-                shutil.rmtree(d)
-            else:
-                print "[QUIT]"
-                sys.exit()
-        # create the new directory
-        os.makedirs(d)
-        # return the full path
-        setattr(namespace, self.dest, d)
+def create_output_dir(d, resume=False):
+    # reuse the directory when resuming
+    if resume and os.path.isdir(d):
+        return
+    # check to see if directory exists
+    if os.path.exists(d):
+        answer = raw_input("[WARNING] Output directory exists, REMOVE [Y/n]? ")
+        if answer == "Y":
+            shutil.rmtree(d)
+        else:
+            print "[QUIT]"
+            sys.exit()
+    # create the new directory
+    os.makedirs(d)
 
 
 def is_dir(dirname):
@@ -113,6 +174,83 @@ def is_file(filename):
         return filename
 
 
+def fingerprint(filename, old=None):
+    """Size, mtime and sha1 of a file.  The hash is reused from old when
+    size and mtime are unchanged, so unchanged files are never reread."""
+    st = os.stat(filename)
+    if old is not None and old["size"] == st.st_size and old["mtime"] == st.st_mtime:
+        return old
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), ""):
+            sha1.update(chunk)
+    return {"size": st.st_size, "mtime": st.st_mtime, "sha1": sha1.hexdigest()}
+
+
+class Manifest(object):
+    """Per-sample record of completed stages (conversion, trimming,
+    alignment, reassignment), with fingerprints of their inputs and
+    outputs, kept as json in the sample output directory"""
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            with open(path) as infile:
+                self.stages = json.load(infile)
+        else:
+            self.stages = {}
+
+    def _same(self, recorded, filename):
+        if recorded is None or not os.path.isfile(filename):
+            return False
+        return fingerprint(filename, recorded)["sha1"] == recorded["sha1"]
+
+    def is_current(self, stage, inputs, params=None):
+        """True if stage completed with these inputs and params and its
+        outputs are still there, unchanged"""
+        entry = self.stages.get(stage)
+        if entry is None or entry["params"] != params:
+            return False
+        if sorted(entry["inputs"]) != sorted(inputs):
+            return False
+        for filename in inputs:
+            if not self._same(entry["inputs"][filename], filename):
+                return False
+        for filename, recorded in entry["outputs"]:
+            if not self._same(recorded, filename):
+                return False
+        return True
+
+    def outputs(self, stage):
+        return [filename for filename, recorded in self.stages[stage]["outputs"]]
+
+    def record(self, stage, inputs, outputs, params=None, seconds=None):
+        old = self.stages.get(stage, {}).get("inputs", {})
+        self.stages[stage] = {
+            "inputs": dict((f, fingerprint(f, old.get(f))) for f in inputs),
+            "outputs": [(f, fingerprint(f)) for f in outputs],
+            "params": params,
+            "completed": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "seconds": seconds
+        }
+        # write-then-rename so an interrupted run never leaves a torn manifest
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as outfile:
+            json.dump(self.stages, outfile, indent=2)
+        os.rename(tmp, self.path)
+
+
+def run_stage(log, manifest, stage, inputs, params, func):
+    """Run func() -> list of output files unless the manifest shows stage
+    is current for these inputs and params"""
+    if manifest.is_current(stage, inputs, params):
+        log.info("Skipping {} (inputs unchanged)".format(stage))
+        return manifest.outputs(stage)
+    start = time.time()
+    outputs = func()
+    manifest.record(stage, inputs, outputs, params, time.time() - start)
+    return outputs
+
+
 def setup_logging(args):
     import __main__ as main
     my_name = os.path.basename(os.path.splitext(main.__file__)[0])
@@ -152,12 +290,11 @@ def convert_fasta_qual_to_fastq(log, directory, sample, output):
     quality = os.path.join(directory, "{}.qual".format(sample))
     # make a similar directory in args.output
     outdir = os.path.join(output, sample)
-    os.mkdir(outdir)
+    if not os.path.isdir(outdir):
+        os.mkdir(outdir)
     # convert current sequences to fastq, writing them out
     fastq = os.path.join(outdir, "{}.fastq".format(sample))
-    with open(fastq, "w") as outf:
-        records = PairedFastaQualIterator(open(fasta), open(quality))
-        count = SeqIO.write(records, outf, "fastq")
+    count = fasta_qual_to_fastq.convert_files(fasta, quality, fastq)
     log.info("Converted {} fasta+qual records to fastq".format(count))
     return outdir, fastq
 
@@ -230,22 +367,37 @@ def create_bowtie_dict(log, output, reference):
     return dict_name
 
 
-def run_bowtie(log, ref_dict_name, fastq):
-    log.info("Running bowtie2")
-    pth, name = os.path.split(fastq)
-    name = name.split(".")[0]
-    out_sam = os.path.join(pth, "{}.sam".format(name))
-    cmd = [
+def create_reference_index(log, output, reference):
+    """Build (or reuse) the reference index shared by all samples: the
+    reference names with fixed integer ids, stored in every report"""
+    index_name = os.path.join(output, "reference.refidx")
+    ref_index = pathoscope_refindex.cached_index(reference, index_name)
+    log.info("Reference index has {} references".format(len(ref_index)))
+    return index_name
+
+
+def get_bowtie_cmd(ref_dict_name, fastq, threads):
+    return [
         "bowtie2",
         "-k",
         "100",
+        "-p",
+        str(threads),
         "-x",
         ref_dict_name,
         "-U",
-        fastq,
-        "-S",
-        out_sam
+        fastq
     ]
+
+
+def run_bowtie(log, ref_dict_name, fastq, threads=1, compress=False):
+    log.info("Running bowtie2")
+    pth, name = os.path.split(fastq)
+    name = name.split(".")[0]
+    out_sam = os.path.join(pth, "{}.sam".format(name))
+    if compress:
+        return compress_bowtie(log, ref_dict_name, fastq, threads, out_sam + ".gz")
+    cmd = get_bowtie_cmd(ref_dict_name, fastq, threads) + ["-S", out_sam]
     with open(os.path.join(pth, "bowtie2.stdout"), 'w') as out:
         proc = subprocess.Popen(cmd, stdout=out, stderr=subprocess.STDOUT)
         stdout, stderr = proc.communicate()
@@ -254,7 +406,30 @@ def run_bowtie(log, ref_dict_name, fastq):
     return out_sam
 
 
-def run_pathoscope(log, sam, sample, outdir):
+def compress_bowtie(log, ref_dict_name, fastq, threads, out_sam):
+    """Run bowtie2 into a gzipped sam: its output is read from a pipe and
+    compressed by a background thread, the plain sam never hits the disk"""
+    proc = stream_bowtie(log, ref_dict_name, fastq, threads)
+    with pathoscope_util.open_file(out_sam, 'w') as out:
+        for block in iter(lambda: proc.stdout.read(1 << 20), ''):
+            out.write(block)
+    proc.stdout.close()
+    if proc.wait() != 0:
+        raise IOError("[bowtie2] exited with status {}".format(proc.returncode))
+    return out_sam
+
+
+def stream_bowtie(log, ref_dict_name, fastq, threads=1):
+    """Start bowtie2 writing sam to a pipe; the caller reads proc.stdout"""
+    log.info("Running bowtie2 (streaming)")
+    pth = os.path.dirname(fastq)
+    cmd = get_bowtie_cmd(ref_dict_name, fastq, threads)
+    with open(os.path.join(pth, "bowtie2.stdout"), 'w') as out:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=out, bufsize=-1)
+    return proc
+
+
+def run_pathoscope(log, sam, sample, outdir, compress=False, columnar=None, ref_index=None):
     log.info("Running pathoscope")
     out_matrix = False
     verbose = False
@@ -263,7 +438,7 @@ def run_pathoscope(log, sam, sample, outdir):
     ali_format = "sam"
     emEpsilon = 1e-7
     maxIter = 50
-    PathoID.pathoscope_reassign(
+    result = PathoID.pathoscope_reassign(
         out_matrix,
         verbose,
         score_cutoff,
@@ -273,8 +448,183 @@ def run_pathoscope(log, sam, sample, outdir):
         outdir,
         emEpsilon,
         maxIter,
-        True
+        True,
+        compressOut=compress,
+        columnarOut=columnar,
+        refIndex=ref_index,
+        profileOut=True
     )
+    outputs = [result[0], result[-1], pathoscope_profile.profile_path(outdir, exp_tag, ali_format)]
+    if columnar:
+        outputs.append(pathoscope_report.report_path(outdir, exp_tag, ali_format, columnar))
+    return outputs
+
+
+def run_sample(work):
+    """Run all stages for one sample, returning (sample, report, error)"""
+    log_name, directory, output, reference, ref_dict_name, ref_index_name, primers, threads, \
+        stream, joint, compress, columnar = work
+    log = logging.getLogger(log_name)
+    sample = os.path.basename(directory)
+    try:
+        # already loaded (and shared) when the workers were forked
+        ref_index = pathoscope_refindex.load_shared(ref_index_name)
+        text = " Running sample {} ".format(sample)
+        log.info(text.center(65, "-"))
+        sample_outdir = os.path.join(output, sample)
+        if not os.path.isdir(sample_outdir):
+            os.mkdir(sample_outdir)
+        manifest = Manifest(os.path.join(sample_outdir, "manifest.json"))
+        # make fastq file
+        fasta = os.path.join(directory, "{}.fasta".format(sample))
+        quality = os.path.join(directory, "{}.qual".format(sample))
+        fastq, = run_stage(log, manifest, "conversion", [fasta, quality], None,
+            lambda: [convert_fasta_qual_to_fastq(log, directory, sample, output)[1]])
+        if primers:
+            # trim primers from fastq
+            fastq, = run_stage(log, manifest, "trimming", [fastq, primers], None,
+                lambda: [trim_primers(log, primers, sample, fastq)])
+        if stream:
+            # run bowtie into pathoscope through a pipe
+            def align_and_reassign():
+                proc = stream_bowtie(log, ref_dict_name, fastq, threads)
+                outputs = run_pathoscope(log, proc.stdout, sample, sample_outdir, compress,
+                    columnar, ref_index)
+                proc.stdout.close()
+                if proc.wait() != 0:
+                    raise IOError("[bowtie2] exited with status {}".format(proc.returncode))
+                return [f for f in outputs if f is not None]
+            outputs = run_stage(log, manifest, "alignment+reassignment", [fastq, reference],
+                {"compress": compress, "columnar": columnar}, align_and_reassign)
+        else:
+            # run bowtie
+            sam, = run_stage(log, manifest, "alignment", [fastq, reference],
+                {"compress": compress},
+                lambda: [run_bowtie(log, ref_dict_name, fastq, threads, compress)])
+            if joint:
+                # reassigned together with the other samples by run_joint
+                return sample, [sam], None
+            # run pathoscope
+            outputs = run_stage(log, manifest, "reassignment", [sam, ref_index_name],
+                {"compress": compress, "columnar": columnar},
+                lambda: run_pathoscope(log, sam, sample, sample_outdir, compress, columnar,
+                    ref_index))
+        return sample, outputs, None
+    except Exception:
+        error = traceback.format_exc()
+        log.critical("Sample {} failed:\n{}".format(sample, error))
+        return sample, None, error
+
+
+def run_joint(log, output, ref_index_name, results, compress=False, columnar=None):
+    """Reassign the aligned samples in one joint EM, returning results with
+    the outputs of every sample replaced by its pathoscope outputs.  The
+    joint EM is one stage of the run-level manifest, whose inputs are the
+    alignments of all samples and the reference index"""
+    aligned = [(sample, outputs[0]) for sample, outputs, error in results if error is None]
+    samples = [sample for sample, sam in aligned]
+    sams = [sam for sample, sam in aligned]
+    outdirs = [os.path.join(output, sample) for sample in samples]
+    manifest = Manifest(os.path.join(output, "manifest.json"))
+
+    def reassign():
+        log.info("Running pathoscope (joint EM)")
+        joint_results, genomes, matrix = PathoID.pathoscope_reassign_joint(
+            False,
+            False,
+            0.01,
+            samples,
+            "sam",
+            sams,
+            outdirs,
+            1e-7,
+            50,
+            True,
+            compressOut=compress,
+            columnarOut=columnar,
+            refIndex=pathoscope_refindex.load_shared(ref_index_name),
+            profileOut=True
+        )
+        outputs = []
+        for sample, outdir, result in zip(samples, outdirs, joint_results):
+            if result is None:
+                continue
+            outputs.extend([result[0], result[-1], pathoscope_profile.profile_path(outdir, sample, "sam")])
+            if columnar:
+                outputs.append(pathoscope_report.report_path(outdir, sample, "sam", columnar))
+        return outputs
+
+    try:
+        outputs = run_stage(log, manifest, "joint", sams + [ref_index_name],
+            {"samples": samples, "compress": compress, "columnar": columnar}, reassign)
+    except Exception:
+        joint_error = traceback.format_exc()
+        log.critical("Joint reassignment failed:\n{}".format(joint_error))
+        # every sample that reached the joint stage failed with it
+        reassigned = dict((sample, (None, joint_error)) for sample in samples)
+    else:
+        reassigned = {}
+        for sample, outdir in zip(samples, outdirs):
+            # the outputs of a sample are the ones in its directory, in order
+            sample_outputs = [f for f in outputs if os.path.dirname(f) == outdir]
+            if sample_outputs:
+                reassigned[sample] = (sample_outputs, None)
+            else:
+                reassigned[sample] = (None, "no alignments")
+    # samples that failed before the joint stage keep their own error
+    return [(sample,) + reassigned.get(sample, (None, sample_error))
+        for sample, sample_outputs, sample_error in results]
+
+
+def summarize_profiles(log, output, results):
+    """Write the run-level summary of the pathoscope profile sidecars of
+    all samples, with the wall time of every pipeline stage of each sample
+    as recorded in its manifest"""
+    paths = {}
+    for sample, outputs, error in results:
+        # samples reassigned by an older run, without a profile, are left out
+        profiles = [f for f in outputs or [] if f.endswith("-profile.json")]
+        if error is None and profiles:
+            paths[sample] = profiles[0]
+    summary = pathoscope_profile.summarize(paths)
+    stages = {}
+    for sample in paths:
+        manifest = Manifest(os.path.join(output, sample, "manifest.json"))
+        row = summary["samples"][sample]
+        row["pipeline"] = dict((stage, entry.get("seconds"))
+            for stage, entry in manifest.stages.items())
+        for stage, seconds in row["pipeline"].items():
+            if seconds is not None:
+                stages[stage] = stages.get(stage, 0.0) + seconds
+    summary["pipeline"] = stages
+    outname = os.path.join(output, "profile_summary.json")
+    with open(outname, "w") as outfile:
+        json.dump(summary, outfile, indent=1, sort_keys=True)
+    for stage, entry in sorted(summary["stages"].items(), key=lambda x: -x[1]["wall"]):
+        log.info("{:<15} {:>10.2f}s total, {:>8.2f}s max ({})".format(stage, entry["wall"],
+            entry["maxWall"], entry["maxWallSample"]))
+    log.info("Wrote profile summary of {} samples to {}".format(len(paths), outname))
+
+
+def aggregate_final_guess(log, output, ref_index_name, results, columnar):
+    """Stack the final guesses of the columnar reports into one
+    samples x references matrix, references in reference index order"""
+    suffix = "-report" + pathoscope_report.FORMATS[columnar]
+    done = []
+    for sample, outputs, error in results:
+        # samples reassigned by an older run, without a report, are left out
+        reports = [f for f in outputs or [] if f.endswith(suffix)]
+        if error is None and reports:
+            done.append((sample, reports[0]))
+    if not done:
+        log.info("No columnar reports to aggregate, skipping final guesses")
+        return
+    samples = [sample for sample, report in done]
+    genomes, matrix = pathoscope_report.aggregate_reports([report for sample, report in done],
+        refIndex=pathoscope_refindex.load_shared(ref_index_name))
+    outname = os.path.join(output, "final_guess.npz")
+    numpy.savez(outname, samples=numpy.array(samples), genomes=genomes, finalGuess=matrix)
+    log.info("Wrote final guesses of {} samples to {}".format(len(samples), outname))
 
 
 def main():
@@ -284,26 +634,38 @@ def main():
     sorted_dirs = sorted(glob.glob(os.path.join(args.fastas, "*")))
     # check for dict
     ref_dict_name = create_bowtie_dict(log, args.output, args.reference)
+    ref_index_name = create_reference_index(log, args.output, args.reference)
     # create_trim_file if we're trimming
     if args.primer_conf:
         primers = create_trim_file(log, args.output, args.primer_conf)
     else:
         primers = False
-    for cnt, directory in enumerate(sorted_dirs):
-        sample = os.path.basename(directory)
-        text = " Running sample {} ".format(sample)
-        log.info(text.center(65, "-"))
-        # make fastq file
-        sample_outdir, fastq = convert_fasta_qual_to_fastq(log, directory, sample, args.output)
-        if args.primer_conf:
-            # trim primers from fastq
-            fastq = trim_primers(log, primers, sample, fastq)
-        # run bowtie
-        sam = run_bowtie(log, ref_dict_name, fastq)
-        # run pathoscope
-        run_pathoscope(log, sam, sample, sample_outdir)
-        if cnt == 10:
-            break
+    # keep the total number of threads within args.cores: each of the
+    # concurrent samples gets bowtie_threads bowtie2 threads
+    threads = max(1, min(args.bowtie_threads, args.cores))
+    workers = max(1, args.cores // threads)
+    log.info("Running {} samples at a time with {} bowtie2 threads each".format(workers, threads))
+    work = [
+        (my_name, directory, args.output, args.reference, ref_dict_name, ref_index_name, primers,
+            threads, args.stream, args.joint, args.compress, args.columnar)
+        for directory in sorted_dirs
+    ]
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.map(run_sample, work, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        results = map(run_sample, work)
+    if args.joint:
+        results = run_joint(log, args.output, ref_index_name, results, args.compress, args.columnar)
+    failed = [sample for sample, outputs, error in results if error is not None]
+    log.info("Completed {} of {} samples".format(len(results) - len(failed), len(results)))
+    if failed:
+        log.critical("Failed samples: {}".format(", ".join(failed)))
+    summarize_profiles(log, args.output, results)
+    if args.columnar:
+        aggregate_final_guess(log, args.output, ref_index_name, results, args.columnar)
     text = " Completed {} ".format(my_name)
     log.info(text.center(65, "="))
 
@@ -7,14 +7,27 @@ Author: Brant Faircloth
 Created by Brant Faircloth on 18 October 2013 11:10 PDT (-0700)
 Copyright (c) 2013 Brant C. Faircloth. All rights reserved.
 
-Description:
+Description: Convert paired fasta+qual files to (Sanger, Phred+33) fastq.
+
+The output is byte-for-byte what Biopython's PairedFastaQualIterator +
+SeqIO.write(..., "fastq") produce, but records are handled as raw line
+buffers: no Seq/SeqRecord objects and the quality tokens are mapped to
+characters through a lookup table instead of int() + chr() per base.
 
 """
 
-import os
 import argparse
-from Bio import SeqIO
-from Bio.SeqIO.QualityIO import PairedFastaQualIterator
+import warnings
+
+PHRED_OFFSET = 33
+MAX_PHRED = 93
+
+# quality token (as written in the .qual file) -> fastq character
+QUAL_CHAR = dict((str(q), chr(q + PHRED_OFFSET)) for q in range(MAX_PHRED + 1))
+
+# number of records buffered before each write to the fastq
+WRITE_BATCH = 1024
+
 
 def get_args():
     """Get arguments from CLI"""
@@ -37,8 +50,111 @@ def get_args():
         )
     return parser.parse_args()
 
-args = get_args()
-with open(args.fastq, "w") as outf:
-    records = PairedFastaQualIterator(open(args.fasta), open(args.qual))
-    count = SeqIO.write(records, outf, "fastq")
-print "Converted {} records".format(count)
+
+def fasta_records(handle):
+    """Yield (title, lines) for each record of a fasta-formatted file,
+    skipping any text before the first record"""
+    title = None
+    lines = []
+    for line in handle:
+        if line[0] == ">":
+            if title is not None:
+                yield title, lines
+            title = line[1:].rstrip()
+            lines = []
+        elif title is not None:
+            lines.append(line)
+    if title is not None:
+        yield title, lines
+
+
+def record_id(title):
+    """The id of a record is the first word of its title"""
+    words = title.split(None, 1)
+    return words[0] if words else ""
+
+
+def quality_string(name, lines):
+    """Convert the lines of a qual record to a Phred+33 string"""
+    tokens = " ".join(lines).split()
+    try:
+        return "".join(map(QUAL_CHAR.__getitem__, tokens))
+    except KeyError:
+        # zero-padded, negative or out-of-range values
+        pass
+    qualities = [int(q) for q in tokens]
+    if min(qualities) < 0:
+        warnings.warn(
+            "Negative quality score {} found in {}, substituting "
+            "PHRED zero instead.".format(min(qualities), name)
+        )
+    if max(qualities) > MAX_PHRED:
+        warnings.warn(
+            "Data loss - max PHRED quality {} in Sanger FASTQ".format(MAX_PHRED)
+        )
+    return "".join(
+        chr(min(MAX_PHRED, max(0, q)) + PHRED_OFFSET) for q in qualities
+    )
+
+
+def convert(fasta, qual, fastq):
+    """Write the records of the fasta and qual handles to the fastq handle,
+    returning the number of records written.  Raises ValueError when the
+    files do not pair up record for record."""
+    count = 0
+    buf = []
+    fasta_iter = fasta_records(fasta)
+    qual_iter = fasta_records(qual)
+    while True:
+        f_rec = next(fasta_iter, None)
+        q_rec = next(qual_iter, None)
+        if f_rec is None and q_rec is None:
+            break
+        if f_rec is None:
+            raise ValueError("FASTA file has more entries than the QUAL file.")
+        if q_rec is None:
+            raise ValueError("QUAL file has more entries than the FASTA file.")
+        title, seq_lines = f_rec
+        name = record_id(title)
+        q_name = record_id(q_rec[0])
+        if name != q_name:
+            raise ValueError(
+                "FASTA and QUAL entries do not match ({} vs {}).".format(
+                    name, q_name
+                )
+            )
+        seq = "".join([l.rstrip() for l in seq_lines])
+        seq = seq.replace(" ", "").replace("\r", "")
+        quals = quality_string(name, q_rec[1])
+        if len(seq) != len(quals):
+            raise ValueError(
+                "Sequence length and number of quality scores disagree "
+                "for {}".format(name)
+            )
+        buf.append("@{}\n{}\n+\n{}\n".format(
+            title.replace("\r", " "), seq, quals
+        ))
+        count += 1
+        if len(buf) >= WRITE_BATCH:
+            fastq.write("".join(buf))
+            buf = []
+    fastq.write("".join(buf))
+    return count
+
+
+def convert_files(fasta, qual, fastq):
+    """convert() on file names"""
+    with open(fasta) as f_in:
+        with open(qual) as q_in:
+            with open(fastq, "w") as outf:
+                return convert(f_in, q_in, outf)
+
+
+def main():
+    args = get_args()
+    count = convert_files(args.fasta, args.qual, args.fastq)
+    print "Converted {} records".format(count)
+
+
+if __name__ == '__main__':
+    main()
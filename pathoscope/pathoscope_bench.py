@@ -0,0 +1,446 @@
+#!/usr/bin/python
+# Offline benchmark of PathoID: synthetic sam / gnu-sam / bl8 alignment
+# files, and the time and memory of each PathoID stage on them, as json
+# that can be compared between two runs. Also times the fasta+qual to
+# fastq conversion of the batch runner against the Biopython one
+
+#	Pathoscope - Predicts strains of genomes in Nextgen seq alignment file (sam/bl8)
+#	Copyright (C) 2013  Johnson Lab - Boston University
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, json, time, random, bisect, shutil, tempfile, platform, argparse
+import multiprocessing
+import PathoID, pathoscope_reader, pathoscope_profile, fasta_qual_to_fastq
+try:
+	import numpy
+except ImportError:
+	numpy = None
+try:
+	from Bio import SeqIO
+	from Bio.SeqIO.QualityIO import PairedFastaQualIterator
+except ImportError:
+	SeqIO = None
+
+FORMATS = {'gnu-sam': 0, 'sam': 1, 'bl8': 2}
+EXTENSIONS = {'gnu-sam': '.gnu-sam', 'sam': '.sam', 'bl8': '.bl8'}
+# score (or e-value, for bl8) cutoff used for each format
+CUTOFFS = {'gnu-sam': 0.01, 'sam': 0.01, 'bl8': 1e-3}
+
+# dataset presets: reads, references, largest number of alignments per
+# read, fraction of uniquely aligned reads
+PRESETS = {
+	'tiny': dict(nReads=2000, nRefs=50, depth=5, uniqueFrac=0.5),
+	'small': dict(nReads=50000, nRefs=500, depth=10, uniqueFrac=0.4),
+	'medium': dict(nReads=500000, nRefs=3000, depth=20, uniqueFrac=0.3),
+	'large': dict(nReads=3000000, nRefs=10000, depth=30, uniqueFrac=0.3),
+}
+
+# ===========================================================
+# Synthetic alignments
+# ===========================================================
+# Reads come from references drawn with Zipf(skew) abundances; a
+# multimapping read also aligns to other references of its "family" (a
+# block of familySize neighbouring references, like strains of a species),
+# its true reference scoring best. scoreDist 'peaked' gives the other
+# alignments clearly lower scores, 'flat' nearly the same ones, which is
+# the harder case for the EM. Lines of a read are consecutive, as aligners
+# write them
+def generate(path, fmt, nReads, nRefs, depth, uniqueFrac, scoreDist='peaked', skew=1.0,
+	familySize=20, seed=0):
+	if fmt not in FORMATS:
+		raise ValueError("unknown alignment format: %s" % fmt)
+	if scoreDist not in ('peaked', 'flat'):
+		raise ValueError("unknown score distribution: %s" % scoreDist)
+	rng = random.Random(seed)
+	cum = []
+	total = 0.0
+	for k in range(nRefs):
+		total += 1.0/(k+1)**skew
+		cum.append(total)
+	# shuffle the abundance ranks over the references
+	rank = range(nRefs)
+	rng.shuffle(rank)
+	familySize = max(1, min(familySize, nRefs))
+	peaked = scoreDist == 'peaked'
+	nLines = 0
+	with open(path, 'w') as of:
+		if fmt != 'bl8':
+			of.write('@HD\tVN:1.0\tSO:unsorted\n')
+			of.write(''.join('@SQ\tSN:ref%d\tLN:1000\n' % k for k in range(nRefs)))
+		buf = []
+		for r in xrange(nReads):
+			true = rank[bisect.bisect_left(cum, rng.random()*total)]
+			refs = [true]
+			if rng.random() >= uniqueFrac and depth > 1:
+				n = rng.randint(2, min(depth, familySize) if familySize > 1 else 2)
+				family = true - true%familySize
+				others = [family+k for k in rng.sample(xrange(familySize), min(n, familySize))
+					if family+k < nRefs and family+k != true]
+				refs.extend(others[:n-1])
+			for (k, ref) in enumerate(refs):
+				# quality of the alignment in [0, 1], best for the true reference
+				if k == 0:
+					qual = rng.uniform(0.8, 1.0)
+				elif peaked:
+					qual = rng.uniform(0.2, 0.8)
+				else:
+					qual = rng.uniform(0.75, 1.0)
+				buf.append(alignment_line(fmt, r, ref, qual))
+			nLines += len(refs)
+			if len(buf) >= 8192:
+				of.write(''.join(buf))
+				buf = []
+		of.write(''.join(buf))
+	return nLines
+
+def alignment_line(fmt, r, ref, qual):
+	if fmt == 'sam':
+		return 'read%d\t0\tref%d\t1\t%d\t4M\t*\t0\t0\tACGT\tIIII\tAS:i:%d\n' % (r, ref,
+			int(qual*42), int((qual-1)*20))
+	if fmt == 'gnu-sam':
+		return 'read%d\t0\tref%d\t1\t255\t4M\t*\t0\t0\tACGT\tIIII\tNM:i:0\tZP:f:%.3g\n' % (r, ref,
+			qual)
+	# bl8: bit score up to 3*mxBitSc, e-value falling with it
+	bitSc = 100+qual*(3*pathoscope_reader.mxBitSc-100)
+	return 'read%d\tref%d\t99.0\t100\t1\t0\t1\t100\t1\t100\t%.2g\t%.1f\n' % (r, ref,
+		10**(-qual*20), bitSc)
+
+# ===========================================================
+# Stages
+# ===========================================================
+# Every measurement runs in a fresh worker process, so that the peak RSS
+# it reports belongs to that stage (and the stages it needs set up) alone
+# and no cache from an earlier measurement is warm. The stage being timed
+# is wrapped by a pathoscope_profile.Profile; its set-up is not timed.
+# Variants of a stage:
+#   parse    dict | compact | collapse
+#   bestHit  default (packing included; the per-read loop without numpy) |
+#            packed (on an already packed matrix)
+#   em       python | numpy | squarem | python-prune | numpy-prune (pruning
+#            genomes below PRUNE)
+#   realign  reparse | indexed (single pass, no second parse)
+STAGES = [
+	('parse', 'dict'), ('parse', 'compact'), ('parse', 'collapse'),
+	('bestHit', 'default'), ('bestHit', 'packed'),
+	('em', 'python'), ('em', 'numpy'), ('em', 'squarem'), ('em', 'python-prune'), ('em', 'numpy-prune'),
+	('realign', 'reparse'), ('realign', 'indexed'),
+]
+NUMPY_VARIANTS = set([('parse', 'compact'), ('parse', 'collapse'), ('bestHit', 'packed'),
+	('em', 'numpy'), ('em', 'squarem'), ('em', 'numpy-prune'), ('realign', 'indexed')])
+# pi threshold of the pruning EM variants
+PRUNE = 1e-6
+
+def run_stage(job):
+	'''(path, fmt, stage, variant, maxIter, workdir) -> stage record'''
+	(path, fmt, stage, variant, maxIter, workdir) = job
+	aliFormat = FORMATS[fmt]
+	cutoff = CUTOFFS[fmt]
+	profile = pathoscope_profile.Profile()
+	if stage == 'parse':
+		rssBefore = pathoscope_profile.peak_rss_kb()
+		rec = profile.begin(stage)
+		(U, NU, genomes, read) = PathoID.conv_align2GRmat(path, cutoff, aliFormat,
+			variant == 'compact', None, variant == 'collapse')
+		profile.end()
+	else:
+		lineIndex = None
+		if stage == 'realign' and variant == 'indexed':
+			lineIndex = pathoscope_reader.AlignLineIndex()
+		(U, NU, genomes, read) = PathoID.conv_align2GRmat(path, cutoff, aliFormat,
+			lineIndex is not None, lineIndex)
+		if stage == 'realign':
+			PathoID.pathoscope_em(U, NU, genomes, maxIter, 1e-7, False)
+		mat = None
+		if stage == 'bestHit' and variant == 'packed':
+			mat = PathoID.pathoscope_matrix.pack_nu(NU)
+		rssBefore = pathoscope_profile.peak_rss_kb()
+		rec = profile.begin(stage)
+		if stage == 'bestHit':
+			PathoID.computeBestHit(U, NU, genomes, read, mat)
+		elif stage == 'em':
+			prune = PRUNE if variant.endswith('-prune') else None
+			if variant.startswith('python'):
+				PathoID.pathoscope_em(U, NU, genomes, maxIter, 1e-7, False, None, rec, prune)
+			else:
+				PathoID.pathoscope_em_numpy(U, NU, genomes, maxIter, 1e-7, False,
+					'squarem' if variant == 'squarem' else None, None, None, rec, prune)
+		elif stage == 'realign':
+			PathoID.rewrite_align(U, NU, path, cutoff, aliFormat, workdir, lineIndex)
+		else:
+			raise ValueError("unknown benchmark stage: %s" % stage)
+		profile.end()
+	rec.update(variant=variant, nR=len(read), nG=len(genomes), nNU=len(NU),
+		rssBeforeKb=rssBefore)
+	del rec['peakRssChildrenKb']
+	return rec
+
+# ===========================================================
+# fasta+qual to fastq
+# ===========================================================
+# Synthetic 454-like reads: lengths uniform in [minLen, maxLen], fasta
+# lines of 60 bases and qual lines of 60 scores, titles with a description
+def generate_fasta_qual(fasta, qual, nReads, minLen=50, maxLen=500, seed=0):
+	rng = random.Random(seed)
+	with open(fasta, 'w') as of:
+		with open(qual, 'w') as oq:
+			fbuf = []
+			qbuf = []
+			for r in xrange(nReads):
+				n = rng.randint(minLen, maxLen)
+				title = '>read%d length=%d\n' % (r, n)
+				seq = ''.join(rng.choice('ACGT') for _ in xrange(n))
+				scores = [str(rng.randint(10, 40)) for _ in xrange(n)]
+				fbuf.append(title + ''.join(seq[k:k+60]+'\n' for k in xrange(0, n, 60)))
+				qbuf.append(title + ''.join(' '.join(scores[k:k+60])+'\n' for k in xrange(0, n, 60)))
+				if len(fbuf) >= 4096:
+					of.write(''.join(fbuf))
+					oq.write(''.join(qbuf))
+					fbuf = []
+					qbuf = []
+			of.write(''.join(fbuf))
+			oq.write(''.join(qbuf))
+
+# converters of the fastq benchmark: 'raw' is fasta_qual_to_fastq (used by
+# the batch runner), 'biopython' the PairedFastaQualIterator + SeqIO.write
+# it replaced
+FASTQ_VARIANTS = ['biopython', 'raw']
+
+def run_fastq_converter(job):
+	'''(fasta, qual, fastq, variant) -> stage record'''
+	(fasta, qual, fastq, variant) = job
+	profile = pathoscope_profile.Profile()
+	rec = profile.begin('fastq')
+	if variant == 'raw':
+		nReads = fasta_qual_to_fastq.convert_files(fasta, qual, fastq)
+	elif variant == 'biopython':
+		with open(fasta) as f_in:
+			with open(qual) as q_in:
+				with open(fastq, 'w') as of:
+					nReads = SeqIO.write(PairedFastaQualIterator(f_in, q_in), of, 'fastq')
+	else:
+		raise ValueError("unknown fastq converter: %s" % variant)
+	profile.end()
+	rec.update(variant=variant, nR=nReads)
+	del rec['peakRssChildrenKb']
+	return rec
+
+# Time both converters (each run in a fresh process, as run_benchmark does)
+# on nReads synthetic reads and check that their fastq files are identical.
+# Results have the layout of run_benchmark, so compare works on them
+def run_fastq_benchmark(nReads, repeat=3, seed=0, workdir=None):
+	variants = FASTQ_VARIANTS if SeqIO is not None else ['raw']
+	ownDir = workdir is None
+	if ownDir:
+		workdir = tempfile.mkdtemp(prefix='pathoscope_bench')
+	name = 'fastq-%d' % nReads
+	results = []
+	try:
+		fasta = os.path.join(workdir, name + '.fasta')
+		qual = os.path.join(workdir, name + '.qual')
+		if not os.path.exists(fasta) or not os.path.exists(qual):
+			generate_fasta_qual(fasta, qual, nReads, seed=seed)
+		outputs = []
+		for variant in variants:
+			fastq = os.path.join(workdir, '%s-%s.fastq' % (name, variant))
+			runs = []
+			for _ in range(repeat):
+				pool = multiprocessing.Pool(1, maxtasksperchild=1)
+				try:
+					runs.append(pool.apply(run_fastq_converter, ((fasta, qual, fastq, variant),)))
+				finally:
+					pool.close()
+					pool.join()
+			outputs.append(fastq)
+			walls = sorted(r['wall'] for r in runs)
+			res = dict(runs[0])
+			res.update(dataset=name, format='fasta+qual', walls=[r['wall'] for r in runs],
+				cpus=[r['cpu'] for r in runs], best=walls[0], median=walls[len(walls)//2],
+				peakRssKb=max(r['peakRssKb'] for r in runs))
+			del res['wall'], res['cpu']
+			results.append(res)
+			print "%-12s %-10s %-12s best %8.3fs  median %8.3fs  peak %8d kB" % (name, 'fastq',
+				variant, res['best'], res['median'], res['peakRssKb'])
+		identical = None
+		if len(outputs) == 2:
+			identical = same_file(outputs[0], outputs[1])
+			print "fastq output of the two converters is %s" % ('identical' if identical
+				else 'DIFFERENT')
+	finally:
+		if ownDir:
+			shutil.rmtree(workdir, True)
+	return {'host': host_info(), 'repeat': repeat, 'results': results,
+		'datasets': {name: {'nReads': nReads, 'seed': seed}}, 'identical': identical}
+
+def same_file(path1, path2):
+	with open(path1, 'rb') as in1:
+		with open(path2, 'rb') as in2:
+			while True:
+				(b1, b2) = (in1.read(1<<20), in2.read(1<<20))
+				if b1 != b2:
+					return False
+				if not b1:
+					return True
+
+# ===========================================================
+def run_benchmark(datasets, stages=None, repeat=3, maxIter=50, workdir=None):
+	'''datasets: [(name, path, fmt)]. Returns the results dict written by
+	main: per dataset, stage and variant the wall and cpu seconds of every
+	repeat, their best and median, and the largest peak RSS'''
+	if stages is None:
+		stages = STAGES
+	if numpy is None:
+		stages = [s for s in stages if s not in NUMPY_VARIANTS]
+	ownDir = workdir is None
+	if ownDir:
+		workdir = tempfile.mkdtemp(prefix='pathoscope_bench')
+	results = []
+	try:
+		for (name, path, fmt) in datasets:
+			for (stage, variant) in stages:
+				runs = []
+				for _ in range(repeat):
+					pool = multiprocessing.Pool(1, maxtasksperchild=1)
+					try:
+						runs.append(pool.apply(run_stage, ((path, fmt, stage, variant, maxIter, workdir),)))
+					finally:
+						pool.close()
+						pool.join()
+				walls = sorted(r['wall'] for r in runs)
+				res = dict(runs[0])
+				res.update(dataset=name, format=fmt, walls=[r['wall'] for r in runs],
+					cpus=[r['cpu'] for r in runs], best=walls[0], median=walls[len(walls)//2],
+					peakRssKb=max(r['peakRssKb'] for r in runs))
+				del res['wall'], res['cpu']
+				results.append(res)
+				print "%-12s %-8s %-8s %-12s best %8.3fs  median %8.3fs  peak %8d kB" % (name, fmt,
+					stage, variant, res['best'], res['median'], res['peakRssKb'])
+	finally:
+		if ownDir:
+			shutil.rmtree(workdir, True)
+	return {'host': host_info(), 'repeat': repeat, 'maxIter': maxIter, 'results': results}
+
+def host_info():
+	return {'python': platform.python_version(), 'platform': platform.platform(),
+		'machine': platform.machine(), 'cpus': multiprocessing.cpu_count(),
+		'numpy': None if numpy is None else numpy.__version__, 'started': time.time()}
+
+# ===========================================================
+# Best times of two benchmark results, keyed by dataset, format, stage and
+# variant: [(key, old, new, new/old)] for the keys both have
+def compare(old, new):
+	h_old = dict(((r['dataset'], r['format'], r['stage'], r['variant']), r['best'])
+		for r in old['results'])
+	rows = []
+	for r in new['results']:
+		key = (r['dataset'], r['format'], r['stage'], r['variant'])
+		if key in h_old:
+			rows.append((key, h_old[key], r['best'], r['best']/h_old[key] if h_old[key] > 0
+				else float('inf')))
+	return rows
+
+# ===========================================================
+def get_args():
+	parser = argparse.ArgumentParser(description="Offline PathoID benchmark")
+	sub = parser.add_subparsers(dest='command')
+	p = sub.add_parser('generate', help="write one synthetic alignment file")
+	p.add_argument('output')
+	p.add_argument('--format', choices=sorted(FORMATS), default='sam')
+	p.add_argument('--preset', choices=sorted(PRESETS), default='small')
+	p.add_argument('--reads', type=int, help="number of reads (overrides the preset)")
+	p.add_argument('--refs', type=int, help="number of references (overrides the preset)")
+	p.add_argument('--depth', type=int, help="most alignments of a read (overrides the preset)")
+	p.add_argument('--unique', type=float, help="fraction of unique reads (overrides the preset)")
+	p.add_argument('--scores', choices=['peaked', 'flat'], default='peaked')
+	p.add_argument('--skew', type=float, default=1.0, help="Zipf exponent of the abundances")
+	p.add_argument('--seed', type=int, default=0)
+	p = sub.add_parser('run', help="generate datasets and time every stage on them")
+	p.add_argument('--output', default='pathoscope_bench.json', help="json results")
+	p.add_argument('--preset', choices=sorted(PRESETS), action='append', dest='presets',
+		help="dataset size, can be repeated (default small)")
+	p.add_argument('--format', choices=sorted(FORMATS), action='append', dest='formats')
+	p.add_argument('--stage', action='append', dest='stages',
+		help="stage or stage:variant to run (default all)")
+	p.add_argument('--scores', choices=['peaked', 'flat'], default='peaked')
+	p.add_argument('--repeat', type=int, default=3)
+	p.add_argument('--max-iter', type=int, default=50)
+	p.add_argument('--seed', type=int, default=0)
+	p.add_argument('--workdir', help="where datasets are generated (default a temporary directory)")
+	p = sub.add_parser('fastq', help="time the fasta+qual to fastq conversion against Biopython")
+	p.add_argument('--output', default='pathoscope_bench_fastq.json', help="json results")
+	p.add_argument('--reads', type=int, default=200000)
+	p.add_argument('--repeat', type=int, default=3)
+	p.add_argument('--seed', type=int, default=0)
+	p.add_argument('--workdir', help="where the reads are generated (default a temporary directory)")
+	p = sub.add_parser('compare', help="compare the best times of two results")
+	p.add_argument('old')
+	p.add_argument('new')
+	return parser.parse_args()
+
+def preset_params(args):
+	params = dict(PRESETS[args.preset])
+	for (key, value) in [('nReads', args.reads), ('nRefs', args.refs), ('depth', args.depth),
+		('uniqueFrac', args.unique)]:
+		if value is not None:
+			params[key] = value
+	return params
+
+def main():
+	args = get_args()
+	if args.command == 'generate':
+		nLines = generate(args.output, args.format, scoreDist=args.scores, skew=args.skew,
+			seed=args.seed, **preset_params(args))
+		print "wrote %d alignments to %s" % (nLines, args.output)
+	elif args.command == 'run':
+		presets = args.presets or ['small']
+		formats = args.formats or ['sam', 'gnu-sam', 'bl8']
+		stages = STAGES
+		if args.stages:
+			stages = [s for s in STAGES if s[0] in args.stages or '%s:%s' % s in args.stages]
+		workdir = args.workdir or tempfile.mkdtemp(prefix='pathoscope_bench')
+		try:
+			datasets = []
+			generated = {}
+			for preset in presets:
+				for fmt in formats:
+					name = '%s-%s' % (preset, args.scores)
+					path = os.path.join(workdir, name + EXTENSIONS[fmt])
+					if not os.path.exists(path):
+						generate(path, fmt, scoreDist=args.scores, seed=args.seed, **PRESETS[preset])
+					datasets.append((name, path, fmt))
+					generated[name] = dict(PRESETS[preset], scoreDist=args.scores, seed=args.seed)
+			results = run_benchmark(datasets, stages, args.repeat, args.max_iter,
+				os.path.join(workdir, 'realign'))
+		finally:
+			if args.workdir is None:
+				shutil.rmtree(workdir, True)
+		results['datasets'] = generated
+		with open(args.output, 'w') as of:
+			json.dump(results, of, indent=1, sort_keys=True)
+		print "results written to %s" % args.output
+	elif args.command == 'fastq':
+		results = run_fastq_benchmark(args.reads, args.repeat, args.seed, args.workdir)
+		with open(args.output, 'w') as of:
+			json.dump(results, of, indent=1, sort_keys=True)
+		print "results written to %s" % args.output
+	else:
+		with open(args.old) as in1:
+			old = json.load(in1)
+		with open(args.new) as in1:
+			new = json.load(in1)
+		for (key, t0, t1, ratio) in compare(old, new):
+			print "%-12s %-8s %-8s %-12s %8.3fs -> %8.3fs  x%.2f" % (key + (t0, t1, ratio))
+
+if __name__ == '__main__':
+	main()
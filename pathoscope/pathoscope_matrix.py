@@ -0,0 +1,274 @@
+#!/usr/bin/python
+# Packed (CSR) read-to-genome matrix used by the numpy code paths of PathoID
+
+#	Pathoscope - Predicts strains of genomes in Nextgen seq alignment file (sam/bl8)
+#	Copyright (C) 2013  Johnson Lab - Boston University
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+from array import array
+from itertools import chain
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# ===========================================================
+def require_numpy(what):
+	if numpy is None:
+		raise ImportError("%s requires numpy, which is not installed" % what)
+
+# ===========================================================
+class GRMatrix(object):
+	'''Non-unique reads packed as a CSR matrix: row i is read nuRead[i] and
+	its alignments are gIdx/score/x[offsets[i]:offsets[i+1]]. When weight
+	is set, row i stands for weight[i] reads sharing that profile.'''
+	def __init__(self, nuRead, offsets, gIdx, score, x, weight=None):
+		self.nuRead = nuRead
+		self.offsets = offsets
+		self.gIdx = gIdx
+		self.score = score
+		self.x = x
+		self.weight = weight
+
+	def __len__(self):
+		return len(self.nuRead)
+
+	def n_reads(self):
+		'''number of reads represented by the rows'''
+		if self.weight is None:
+			return len(self.nuRead)
+		return int(self.weight.sum())
+
+	def lengths(self):
+		return numpy.diff(self.offsets)
+
+	def row_of_entry(self):
+		'''row index of every packed entry (the expanded CSR indptr)'''
+		return numpy.repeat(numpy.arange(len(self.nuRead), dtype=numpy.int64),
+			self.lengths())
+
+# ===========================================================
+def pack_nu(NU):
+	'''pack the NU dict {rIdx: [[genomes],[qij],[xij]]} into a GRMatrix,
+	rows in NU iteration order so that sums over the rows add up in the
+	same order as the loops over NU do'''
+	require_numpy("pack_nu")
+	if isinstance(NU, NUView):
+		return NU.mat
+	nuRead = numpy.fromiter(NU, dtype=numpy.int64, count=len(NU))
+	rows = NU.values()
+	lengths = numpy.fromiter((len(z[0]) for z in rows),
+		dtype=numpy.int64, count=len(rows))
+	offsets = numpy.zeros(len(nuRead)+1, dtype=numpy.int64)
+	numpy.cumsum(lengths, out=offsets[1:])
+	nEntries = int(offsets[-1])
+	gIdx = numpy.fromiter(chain.from_iterable(z[0] for z in rows),
+		dtype=numpy.int32, count=nEntries)
+	score = numpy.fromiter(chain.from_iterable(z[1] for z in rows),
+		dtype=numpy.float64, count=nEntries)
+	x = numpy.fromiter(chain.from_iterable(z[2] for z in rows),
+		dtype=numpy.float64, count=nEntries)
+	return GRMatrix(nuRead, offsets, gIdx, score, x)
+
+def unpack_x(mat, NU):
+	'''copy the packed x values back into NU[rIdx][2]'''
+	if isinstance(NU, NUView):
+		return
+	offsets = mat.offsets.tolist()
+	x = mat.x.tolist()
+	for i, j in enumerate(mat.nuRead.tolist()):
+		NU[j][2] = x[offsets[i]:offsets[i+1]]
+
+def pack_x(mat, NU):
+	'''copy NU[rIdx][2] into the packed x values (the inverse of unpack_x)'''
+	if isinstance(NU, NUView):
+		return
+	mat.x = numpy.fromiter(chain.from_iterable(NU[j][2] for j in mat.nuRead.tolist()),
+		dtype=numpy.float64, count=len(mat.gIdx))
+
+# ===========================================================
+# Append-only builder used by conv_align2GRmat(compact=True). Alignments
+# are kept as three typed arrays (read index, genome index, score) instead
+# of per-read nested lists; duplicate (read, genome) pairs are dropped and
+# the reads split into unique/non-unique at build time.
+# ===========================================================
+class GRMatrixBuilder(object):
+	def __init__(self, scoreType='H'):
+		self.rIdx = array('i')
+		self.gIdx = array('i')
+		self.score = array(scoreType)
+
+	def append(self, rIdx, gIdx, pScore):
+		self.rIdx.append(rIdx)
+		self.gIdx.append(gIdx)
+		self.score.append(pScore)
+
+	def __len__(self):
+		return len(self.rIdx)
+
+	def extend(self, rIdx, gIdx, score):
+		'''append whole numpy arrays'''
+		self.rIdx.fromstring(rIdx.astype(self.rIdx.typecode).tostring())
+		self.gIdx.fromstring(gIdx.astype(self.gIdx.typecode).tostring())
+		self.score.fromstring(score.astype(self.score.typecode).tostring())
+
+	def build(self, nR, nG, collapse=False):
+		'''return (U, NU) views over the packed alignments of nR reads. With
+		collapse, NU reads with the same (genome, score) profile share one
+		weighted matrix row'''
+		require_numpy("GRMatrixBuilder")
+		r = numpy.frombuffer(self.rIdx, dtype=numpy.int32)
+		g = numpy.frombuffer(self.gIdx, dtype=numpy.int32)
+		s = numpy.frombuffer(self.score, dtype=numpy.dtype(self.score.typecode))
+		# keep the first alignment of each (read, genome) pair, in input order
+		key = r.astype(numpy.int64)*max(nG, 1)+g
+		_, first = numpy.unique(key, return_index=True)
+		first.sort()
+		# group by read, keeping the input order within a read
+		order = first[numpy.argsort(r[first], kind='mergesort')]
+		r = r[order]
+		g = g[order]
+		s = s[order]
+		del key, first, order
+		self.rIdx = self.gIdx = self.score = None
+
+		counts = numpy.bincount(r, minlength=nR)
+		uGenome = numpy.repeat(numpy.int32(-1), nR)
+		single = counts[r] == 1
+		uGenome[r[single]] = g[single]
+
+		multi = ~single
+		nuRead = numpy.flatnonzero(counts > 1)
+		offsets = numpy.zeros(len(nuRead)+1, dtype=numpy.int64)
+		numpy.cumsum(counts[nuRead], out=offsets[1:])
+		gIdx = g[multi]
+		score = s[multi]
+		mat = GRMatrix(nuRead, offsets, gIdx, score, None)
+		rowOf = mat.row_of_entry()
+		pScoreSum = numpy.bincount(rowOf, weights=score, minlength=len(nuRead))
+		mat.x = score/pScoreSum[rowOf] #Normalizing pScore
+		nuRow = numpy.repeat(numpy.int32(-1), nR)
+		if collapse:
+			(mat, classOf) = collapse_profiles(mat)
+			nuRow[nuRead] = classOf
+		else:
+			nuRow[nuRead] = numpy.arange(len(nuRead), dtype=numpy.int32)
+		return UView(uGenome), NUView(mat, nuRow, nuRead)
+
+# ===========================================================
+# Equivalence classes of NU reads: reads aligning to the same genomes with
+# the same scores (in any order) get identical x in every EM iteration, so
+# the EM only needs one row per class, weighted by its number of reads
+# ===========================================================
+def collapse_profiles(mat):
+	'''return (class matrix, class row of every row of mat)'''
+	rowOf = mat.row_of_entry()
+	# profile key: the row's entries sorted by genome
+	order = numpy.lexsort((mat.gIdx, rowOf))
+	g = mat.gIdx[order]
+	s = mat.score[order]
+	offsets = mat.offsets.tolist()
+	h_profile = {}
+	classOf = numpy.empty(len(mat), dtype=numpy.int32)
+	for i in xrange(len(mat)):
+		key = g[offsets[i]:offsets[i+1]].tostring()+s[offsets[i]:offsets[i+1]].tostring()
+		classOf[i] = h_profile.setdefault(key, len(h_profile))
+	del h_profile, order, g, s
+
+	# each class keeps the entries of its first row
+	_, rep = numpy.unique(classOf, return_index=True)
+	lengths = mat.lengths()[rep]
+	classOffsets = numpy.zeros(len(rep)+1, dtype=numpy.int64)
+	numpy.cumsum(lengths, out=classOffsets[1:])
+	take = numpy.repeat(mat.offsets[rep]-classOffsets[:-1], lengths)+numpy.arange(classOffsets[-1])
+	weight = numpy.bincount(classOf, minlength=len(rep)).astype(numpy.float64)
+	classMat = GRMatrix(mat.nuRead[rep], classOffsets, mat.gIdx[take], mat.score[take],
+		mat.x[take], weight)
+	return classMat, classOf
+
+# ===========================================================
+# Thin dict-like views so code written against the U/NU dicts
+# (computeBestHit, rewrite_align, pathoscope_em) runs unchanged on a
+# packed matrix
+# ===========================================================
+class UView(collections.Mapping):
+	'''{rIdx: gIdx} for the uniquely aligned reads'''
+	def __init__(self, uGenome):
+		self.uGenome = uGenome
+		self.uRead = numpy.flatnonzero(uGenome >= 0)
+
+	def __getitem__(self, rIdx):
+		if rIdx in self:
+			return int(self.uGenome[rIdx])
+		raise KeyError(rIdx)
+
+	def __contains__(self, rIdx):
+		return 0 <= rIdx < len(self.uGenome) and self.uGenome[rIdx] >= 0
+
+	def __iter__(self):
+		return iter(self.uRead.tolist())
+
+	def __len__(self):
+		return len(self.uRead)
+
+	def genomes(self):
+		return self.uGenome[self.uRead]
+
+class NUView(collections.Mapping):
+	'''{rIdx: [[genomes],[qij],[xij]]} for the non-unique reads nuRead;
+	nuRow maps a read to its row of mat'''
+	def __init__(self, mat, nuRow, nuRead):
+		self.mat = mat
+		self.nuRow = nuRow
+		self.nuRead = nuRead
+
+	def __getitem__(self, rIdx):
+		if rIdx in self:
+			return NURow(self.mat, int(self.nuRow[rIdx]))
+		raise KeyError(rIdx)
+
+	def __contains__(self, rIdx):
+		return 0 <= rIdx < len(self.nuRow) and self.nuRow[rIdx] >= 0
+
+	def __iter__(self):
+		return iter(self.nuRead.tolist())
+
+	def __len__(self):
+		return len(self.nuRead)
+
+class NURow(object):
+	'''one NU entry; element 2 (xij) can be assigned back into the matrix'''
+	def __init__(self, mat, row):
+		self.mat = mat
+		self.start = int(mat.offsets[row])
+		self.end = int(mat.offsets[row+1])
+
+	def __getitem__(self, k):
+		if k == 0:
+			return self.mat.gIdx[self.start:self.end].tolist()
+		elif k == 1:
+			return self.mat.score[self.start:self.end].tolist()
+		elif k == 2:
+			return self.mat.x[self.start:self.end].tolist()
+		raise IndexError(k)
+
+	def __setitem__(self, k, values):
+		if k != 2:
+			raise TypeError("only xij can be updated in a packed NU row")
+		self.mat.x[self.start:self.end] = values
+
+	def __len__(self):
+		return 3
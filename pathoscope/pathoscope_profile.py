@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# Per-stage instrumentation of a PathoID run: wall and CPU time, peak RSS
+# and the counts of each stage, written as a json sidecar next to the report
+
+#	Pathoscope - Predicts strains of genomes in Nextgen seq alignment file (sam/bl8)
+#	Copyright (C) 2013  Johnson Lab - Boston University
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, time, json, resource
+
+# ===========================================================
+# CPU seconds (user+system) of this process and of its children that have
+# been waited for (the workers of a sharded parse)
+def cpu_time():
+	t = os.times()
+	return t[0]+t[1]+t[2]+t[3]
+
+# high-water mark of the resident set so far, in kB (linux reports kB,
+# darwin bytes)
+def peak_rss_kb(who=resource.RUSAGE_SELF):
+	rss = resource.getrusage(who).ru_maxrss
+	if os.uname()[0] == 'Darwin':
+		rss //= 1024
+	return rss
+
+# ===========================================================
+class Profile(object):
+	'''stages in the order they ran, each a dict with its name, wall and cpu
+	seconds, the peak RSS of the process (and of its children) at the end
+	of the stage, and the counts the stage added to it'''
+	def __init__(self, **counts):
+		self.stages = []
+		self.counts = counts
+		self.started = time.time()
+		self.running = None
+
+	def begin(self, name, **counts):
+		'''start timing a stage (ending the running one); returns its record,
+		for the counts'''
+		if self.running is not None:
+			self.end()
+		rec = dict(counts, stage=name)
+		self.running = (rec, time.time(), cpu_time())
+		return rec
+
+	def end(self):
+		(rec, wall, cpu) = self.running
+		self.running = None
+		rec['wall'] = time.time()-wall
+		rec['cpu'] = cpu_time()-cpu
+		rec['peakRssKb'] = peak_rss_kb()
+		rec['peakRssChildrenKb'] = peak_rss_kb(resource.RUSAGE_CHILDREN)
+		self.stages.append(rec)
+		return rec
+
+	def add(self, rec):
+		'''a stage measured elsewhere (e.g. an EM shared by several samples)'''
+		self.stages.append(dict(rec))
+
+	def to_dict(self):
+		return {'started': self.started, 'counts': self.counts, 'stages': self.stages,
+			'total': {'wall': sum(s['wall'] for s in self.stages),
+				'cpu': sum(s['cpu'] for s in self.stages),
+				'peakRssKb': max([s['peakRssKb'] for s in self.stages] or [0])}}
+
+	def write(self, path):
+		if self.running is not None:
+			self.end()
+		with open(path, 'w') as of:
+			json.dump(self.to_dict(), of, indent=1, sort_keys=True)
+		return path
+
+# ===========================================================
+def profile_path(outdir, expTag, ali_format):
+	return outdir + os.sep + expTag + '-' + ali_format + '-profile.json'
+
+def load_profile(path):
+	with open(path) as in1:
+		return json.load(in1)
+
+# ===========================================================
+# Run-level summary of many sidecars, {sample: path}: per stage the total,
+# mean and largest wall time (with the sample it belongs to), the total
+# cpu time and the largest peak RSS; per sample its totals and counts.
+# A stage shared by several samples (the joint EM, whose records carry
+# the same 'shared' id) counts once in the stage totals, its n and its
+# mean, and is flagged 'joint'
+def summarize(paths):
+	h_stage = {}
+	h_shared = set()
+	samples = {}
+	for (sample, path) in sorted(paths.items()):
+		prof = load_profile(path)
+		row = dict(prof['total'])
+		row['counts'] = prof['counts']
+		for rec in prof['stages']:
+			# per-sample counts of every stage (nR, nG, EM iterations, ...)
+			for (k, v) in rec.items():
+				if k not in ('stage', 'shared', 'wall', 'cpu', 'peakRssKb', 'peakRssChildrenKb'):
+					row['counts'][rec['stage']+'.'+k] = v
+			s = h_stage.setdefault(rec['stage'], {'n': 0, 'wall': 0.0, 'cpu': 0.0,
+				'maxWall': 0.0, 'maxWallSample': None, 'peakRssKb': 0})
+			if rec.get('joint'):
+				if (rec['stage'], rec['shared']) in h_shared:
+					continue
+				h_shared.add((rec['stage'], rec['shared']))
+				s['joint'] = True
+			s['n'] += 1
+			s['wall'] += rec['wall']
+			s['cpu'] += rec['cpu']
+			if rec['wall'] >= s['maxWall']:
+				(s['maxWall'], s['maxWallSample']) = (rec['wall'], sample)
+			s['peakRssKb'] = max(s['peakRssKb'], rec['peakRssKb'])
+		samples[sample] = row
+	for s in h_stage.values():
+		s['meanWall'] = s['wall']/s['n']
+	return {'samples': samples, 'stages': h_stage,
+		'total': {'samples': len(samples),
+			'wall': sum(r['wall'] for r in samples.values()),
+			'cpu': sum(r['cpu'] for r in samples.values()),
+			'peakRssKb': max([r['peakRssKb'] for r in samples.values()] or [0])}}
@@ -0,0 +1,242 @@
+#!/usr/bin/python
+# Streaming reader for the alignment formats understood by PathoID
+# (gnu-sam, sam and bl8), shared by conv_align2GRmat and rewrite_align
+
+#	Pathoscope - Predicts strains of genomes in Nextgen seq alignment file (sam/bl8)
+#	Copyright (C) 2013  Johnson Lab - Boston University
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, math
+from array import array
+
+mxBitSc = 700
+sigma2 = 3
+
+# Number of tab splits needed per format: only the columns up to the score
+# column are split off, the rest of the line stays in the last element so
+# that '\t'.join(l) gives back the original line
+nSplit = {
+	0: 13, # gnu-sam: readId, refId (2), score tag (12)
+	1: 5,  # sam: readId, refId (2), mapq (4)
+	2: 12, # bl8: readId, refId (1), e-value (10), bit score (11)
+}
+
+# Scores are cached by the text of their column(s): sam mapq values and
+# gnu-sam probabilities come from a small set, so most lines skip the
+# float conversion and pow/exp entirely
+maxCache = 1 << 16
+
+# ===========================================================
+def line_score(aliFormat, l, ln, pScoreCutoff, warn=True):
+	'''integer score used by the EM for a split alignment line, 0 if the
+	line does not pass the cutoff and -1 if it cannot be parsed'''
+	if (aliFormat == 0): # gnu-sam
+		if len(l) < 13:
+			if warn:
+				print "line has no score entry: %s" %(ln)
+			return -1
+		scoreStringList = l[12].split(':')
+		if len(scoreStringList) < 3:
+			if warn:
+				print "Number format error in line: %s" %(ln)
+			return -1
+		pScore = float(scoreStringList[2])
+		if (pScore == float('Inf')):
+			pScore = 1.0
+		if (pScore < pScoreCutoff):
+			return 0
+	elif (aliFormat == 1): # sam
+		mapq = float(l[4])
+		mapq2 = mapq/(-10.0)
+		pScore = 1.0 - pow(10,mapq2)
+		if (pScore < pScoreCutoff):
+			return 0
+	elif (aliFormat == 2): # bl8
+		eVal = float(l[10])
+		if (eVal > pScoreCutoff):
+			return 0
+		bitSc = float(l[11])/sigma2
+		if bitSc > mxBitSc:
+			bitSc = mxBitSc
+		pScore = math.exp(bitSc)
+	pScore = int(round(pScore*100)) # Converting to integer to conserve memory space
+	if pScore < 1:
+		return 0
+	return pScore
+
+def iter_read_groups(in1, aliFormat, pScoreCutoff, header=None, warn=True):
+	'''yield (readId, [(refId, pScore, ln, l, lineNo), ...]) for each run
+	of consecutive alignments of the same read that pass the score cutoff.
+	pScore is the integer score used by the EM, l is the line split up to
+	(and including) its score column and lineNo counts the non-header
+	lines of the file from 0. On name-sorted or collated input
+	(bowtie2 output) every read comes out as exactly one group; otherwise
+	a read can show up in several groups. Header lines are passed to
+	header(ln) when it is given.'''
+	maxsplit = nSplit[aliFormat]
+	refCol = 1 if aliFormat == 2 else 2
+	cache = {}
+	readId = None
+	group = []
+	lineNo = -1
+	for ln in in1:
+		if (ln[0] == '@' or ln[0] == '#'):
+			if header is not None:
+				header(ln)
+			continue
+		lineNo += 1
+
+		l = ln.split('\t', maxsplit)
+
+		refId = l[refCol]
+		if refId == '*':
+			continue
+
+		if (aliFormat == 1): # sam
+			key = l[4]
+		elif (aliFormat == 0): # gnu-sam
+			key = l[12] if len(l) > 12 else None
+		else: # bl8
+			key = (l[10], l[11])
+		pScore = cache.get(key)
+		if pScore is None:
+			pScore = line_score(aliFormat, l, ln, pScoreCutoff, warn)
+			if pScore >= 0 and key is not None and len(cache) < maxCache:
+				cache[key] = pScore
+		if pScore < 1:
+			continue
+
+		if l[0] != readId:
+			if group:
+				yield readId, group
+			readId = l[0]
+			group = []
+		group.append((refId, pScore, ln, l, lineNo))
+	if group:
+		yield readId, group
+
+# ===========================================================
+# Filled by conv_align2GRmat for every alignment it keeps, so that
+# rewrite_align can stream the file a second time without scoring or
+# hashing anything: line number (non-header lines), read and genome index,
+# and whether it was the first kept line of its read.
+# ===========================================================
+class AlignLineIndex(object):
+	def __init__(self):
+		self.lineNo = array('I')
+		self.rIdx = array('i')
+		self.gIdx = array('i')
+		self.first = array('b')
+
+	def append(self, lineNo, rIdx, gIdx, first):
+		self.lineNo.append(lineNo)
+		self.rIdx.append(rIdx)
+		self.gIdx.append(gIdx)
+		self.first.append(first)
+
+	def __len__(self):
+		return len(self.lineNo)
+
+	def extend(self, lineNo, rIdx, gIdx, first):
+		'''append whole numpy arrays (see conv_align2GRmat_sharded)'''
+		self.lineNo.fromstring(lineNo.astype(self.lineNo.typecode).tostring())
+		self.rIdx.fromstring(rIdx.astype(self.rIdx.typecode).tostring())
+		self.gIdx.fromstring(gIdx.astype(self.gIdx.typecode).tostring())
+		self.first.fromstring(first.astype(self.first.typecode).tostring())
+
+# ===========================================================
+# Sharded parsing: a (plain, seekable) alignment file is cut into byte
+# ranges that start at a line where the read id changes, and each range is
+# parsed on its own by parse_shard, in a worker process
+# ===========================================================
+def shard_bounds(fname, nShards):
+	'''byte offsets [0, b1, ..., size] of up to nShards ranges of fname'''
+	size = os.path.getsize(fname)
+	bounds = [0]
+	with open(fname, 'rb') as in1:
+		for k in range(1, nShards):
+			pos = max(size*k//nShards, bounds[-1])
+			if pos >= size:
+				break
+			in1.seek(pos)
+			if pos > 0:
+				in1.readline() # to the start of the next line
+			pos = in1.tell()
+			readId = None
+			while True:
+				ln = in1.readline()
+				if not ln:
+					pos = size
+					break
+				if not (ln[0] == '@' or ln[0] == '#'):
+					rId = ln.split('\t', 1)[0]
+					if readId is not None and rId != readId:
+						break
+					readId = rId
+				pos += len(ln)
+			if pos > bounds[-1] and pos < size:
+				bounds.append(pos)
+	bounds.append(size)
+	return bounds
+
+def iter_range(in1, start, end):
+	'''the lines of in1 from byte start up to byte end (both line starts)'''
+	in1.seek(start)
+	pos = start
+	for ln in in1:
+		if pos >= end:
+			break
+		pos += len(ln)
+		yield ln
+
+def parse_shard(job):
+	'''parse the byte range [start, end) of fname: returns the names of the
+	reads and genomes in order of appearance, the packed (as strings) read
+	index, genome index, score and line number of every kept alignment,
+	all local to the range, and the number of non-header lines in it'''
+	(fname, start, end, aliFormat, pScoreCutoff, scoreType) = job
+	h_readId = {}
+	h_refId = {}
+	read = []
+	genomes = []
+	rIdxs = array('i')
+	gIdxs = array('i')
+	scores = array(scoreType)
+	lineNos = array('I')
+	nHeader = [0]
+	def header(ln):
+		nHeader[0] += 1
+	nLines = [0]
+	def lines(in1):
+		for ln in iter_range(in1, start, end):
+			nLines[0] += 1
+			yield ln
+	with open(fname, 'rb') as in1:
+		for (readId, alns) in iter_read_groups(lines(in1), aliFormat, pScoreCutoff, header):
+			rIdx = h_readId.get(readId, -1)
+			if rIdx == -1:
+				rIdx = h_readId[readId] = len(read)
+				read.append(readId)
+			for (refId, pScore, _, _, lineNo) in alns:
+				gIdx = h_refId.get(refId, -1)
+				if gIdx == -1:
+					gIdx = h_refId[refId] = len(genomes)
+					genomes.append(refId)
+				rIdxs.append(rIdx)
+				gIdxs.append(gIdx)
+				scores.append(pScore)
+				lineNos.append(lineNo)
+	return (read, genomes, rIdxs.tostring(), gIdxs.tostring(), scores.tostring(), lineNos.tostring(),
+		nLines[0]-nHeader[0])
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# Reference index: the reference names of an alignment database with
+# fixed integer ids, built once from the reference fasta (or a sam @SQ
+# header) and shared by all the samples aligned against it
+
+#	Pathoscope - Predicts strains of genomes in Nextgen seq alignment file (sam/bl8)
+#	Copyright (C) 2013  Johnson Lab - Boston University
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import pathoscope_util
+
+# first line of a saved index: tag, then size and mtime of its source
+indexTag = '#pathoscope-refindex'
+
+# indexes loaded by this process, by path. Filled before the batch runner
+# forks its workers so that they share a single copy
+h_loaded = {}
+
+# ===========================================================
+class RefIndex(object):
+	'''reference names (interned) in a fixed order; the id of a reference
+	is its position'''
+	def __init__(self, names):
+		self.names = [intern(n) for n in names]
+		self.h_refId = dict((n, i) for (i, n) in enumerate(self.names))
+		if len(self.h_refId) != len(self.names):
+			raise ValueError("duplicate reference names in the reference index")
+
+	def __len__(self):
+		return len(self.names)
+
+	def ref_id(self, name):
+		try:
+			return self.h_refId[name]
+		except KeyError:
+			raise ValueError("reference %s is not in the reference index" % name)
+
+	def ref_ids(self, names):
+		return [self.ref_id(n) for n in names]
+
+	def save(self, path, source=None):
+		# write-then-rename so concurrent readers never see a partial index
+		tmp = path + '.tmp'
+		with open(tmp, 'w') as of:
+			if source is None:
+				of.write(indexTag + '\n')
+			else:
+				st = os.stat(source)
+				of.write('%s\t%d\t%r\n' % (indexTag, st.st_size, st.st_mtime))
+			for n in self.names:
+				of.write(n + '\n')
+		os.rename(tmp, path)
+
+# ===========================================================
+# bowtie2 (and most aligners) name a reference by the first word of its
+# fasta title
+def from_fasta(fasta):
+	names = []
+	with pathoscope_util.open_file(fasta, 'r') as in1:
+		for ln in in1:
+			if ln[0] == '>':
+				title = ln[1:].split(None, 1)
+				names.append(title[0] if title else '')
+	return RefIndex(names)
+
+# the @SQ lines of a sam header, in order
+def from_sam_header(samFile):
+	names = []
+	with pathoscope_util.open_file(samFile, 'r') as in1:
+		for ln in in1:
+			if ln[0] != '@':
+				break
+			if ln.startswith('@SQ'):
+				for field in ln.rstrip('\r\n').split('\t')[1:]:
+					if field.startswith('SN:'):
+						names.append(field[3:])
+						break
+	return RefIndex(names)
+
+# ===========================================================
+def load(path):
+	with open(path) as in1:
+		header = in1.readline()
+		if not header.startswith(indexTag):
+			raise ValueError("%s is not a reference index" % path)
+		return RefIndex([ln.rstrip('\n') for ln in in1])
+
+# the source (size, mtime) recorded in a saved index, None if unknown
+def saved_source(path):
+	with open(path) as in1:
+		fields = in1.readline().rstrip('\n').split('\t')
+	if fields[0] != indexTag or len(fields) != 3:
+		return None
+	return (int(fields[1]), float(fields[2]))
+
+# Reference index of a fasta, saved to path: reused while the fasta is
+# unchanged (same size and mtime), rebuilt otherwise
+def cached_index(fasta, path):
+	if os.path.exists(path):
+		st = os.stat(fasta)
+		if saved_source(path) == (st.st_size, st.st_mtime):
+			return load_shared(path)
+	index = from_fasta(fasta)
+	index.save(path, fasta)
+	h_loaded[path] = index
+	return index
+
+# the saved index at path, loaded once per process
+def load_shared(path):
+	index = h_loaded.get(path)
+	if index is None:
+		index = load(path)
+		h_loaded[path] = index
+	return index
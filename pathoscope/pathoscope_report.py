@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# Columnar (npz / parquet) copy of the PathoID report, and a loader that
+# memory-maps it for cross-sample aggregation
+
+#	Pathoscope - Predicts strains of genomes in Nextgen seq alignment file (sam/bl8)
+#	Copyright (C) 2013  Johnson Lab - Boston University
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, struct, zipfile
+try:
+	import numpy
+except ImportError:
+	numpy = None
+try:
+	import pyarrow
+	import pyarrow.parquet
+except ImportError:
+	pyarrow = None
+
+# Report columns, in the order of the tsv report. Unlike the tsv, the
+# columnar report keeps every genome, in genome index order (unsorted and
+# not truncated), next to a 'genomes' array of names and the 0-d 'nReads'.
+# Reports of samples run against a reference index also have 'refIds', the
+# id of every genome in that index
+REPORT_COLUMNS = ['finalGuess', 'finalBestHit', 'finalBestHitReads', 'finalHighConfidence',
+	'finalLowConfidence', 'initGuess', 'initBestHit', 'initBestHitReads', 'initHighConfidence',
+	'initLowConfidence']
+
+FORMATS = {'npz': '.npz', 'parquet': '.parquet'}
+
+# ===========================================================
+def report_path(outdir, expTag, ali_format, fmt):
+	if fmt not in FORMATS:
+		raise ValueError("unknown columnar report format: %s" % fmt)
+	return outdir + os.sep + expTag + '-' + ali_format + '-report' + FORMATS[fmt]
+
+# ===========================================================
+# columns maps every name of REPORT_COLUMNS to a per-genome list
+def write_report(path, fmt, genomes, nR, columns, refIds=None):
+	if numpy is None:
+		raise ImportError("the columnar report requires numpy, which is not installed")
+	arrays = dict((c, numpy.asarray(columns[c], dtype=numpy.float64)) for c in REPORT_COLUMNS)
+	if fmt == 'npz':
+		arrays['genomes'] = numpy.array(genomes, dtype=numpy.string_)
+		arrays['nReads'] = numpy.array(nR, dtype=numpy.int64)
+		if refIds is not None:
+			arrays['refIds'] = numpy.array(refIds, dtype=numpy.int32)
+		# stored, not deflated, so that load_report can memory-map the members
+		numpy.savez(path, **arrays)
+	elif fmt == 'parquet':
+		if pyarrow is None:
+			raise ImportError("the parquet report requires pyarrow, which is not installed")
+		names = ['genomes'] + REPORT_COLUMNS
+		data = [pyarrow.array(genomes, type=pyarrow.string())] + \
+			[pyarrow.array(arrays[c]) for c in REPORT_COLUMNS]
+		if refIds is not None:
+			names.append('refIds')
+			data.append(pyarrow.array(numpy.array(refIds, dtype=numpy.int32)))
+		table = pyarrow.Table.from_arrays(data, names=names)
+		table = table.replace_schema_metadata({'nReads': str(nR)})
+		pyarrow.parquet.write_table(table, path)
+	else:
+		raise ValueError("unknown columnar report format: %s" % fmt)
+	return path
+
+# ===========================================================
+# {name: array} for a report written by write_report, restricted to the
+# given columns (plus genomes, nReads and refIds) if any. npz members are
+# memory-mapped (read-only) rather than read; parquet columns come from a
+# memory-mapped read of the file
+def load_report(path, columns=None):
+	if columns is None:
+		columns = REPORT_COLUMNS
+	if numpy is None:
+		raise ImportError("the columnar report requires numpy, which is not installed")
+	if path.endswith(FORMATS['parquet']):
+		if pyarrow is None:
+			raise ImportError("the parquet report requires pyarrow, which is not installed")
+		columns = list(columns)
+		if 'refIds' in pyarrow.parquet.read_schema(path).names:
+			columns.append('refIds')
+		table = pyarrow.parquet.read_table(path, columns=['genomes']+columns, memory_map=True)
+		report = {'genomes': numpy.array(table.column('genomes').to_pylist(), dtype=numpy.string_),
+			'nReads': int(table.schema.metadata['nReads'])}
+		for c in columns:
+			chunks = table.column(c).chunks
+			if len(chunks) == 1:
+				report[c] = chunks[0].to_numpy()
+			else:
+				report[c] = numpy.concatenate([k.to_numpy() for k in chunks])
+		return report
+	report = mmap_npz(path, ['genomes', 'nReads', 'refIds']+list(columns))
+	report['nReads'] = int(report['nReads'])
+	return report
+
+# numpy.load ignores mmap_mode for npz files; members that are stored
+# uncompressed (numpy.savez) are plain .npy files at a fixed offset of the
+# zip, so map them directly. Only the members in names are loaded when
+# names is given
+def mmap_npz(path, names=None):
+	arrays = {}
+	with zipfile.ZipFile(path) as zf:
+		with open(path, 'rb') as f:
+			for info in zf.infolist():
+				name = info.filename
+				if name.endswith('.npy'):
+					name = name[:-4]
+				if names is not None and name not in names:
+					continue
+				if info.compress_type != zipfile.ZIP_STORED:
+					arrays[name] = numpy.lib.format.read_array(zf.open(info))
+					continue
+				# skip the local file header: its extra field can differ
+				# from the one in the central directory
+				f.seek(info.header_offset+26)
+				(nameLen, extraLen) = struct.unpack('<HH', f.read(4))
+				f.seek(info.header_offset+30+nameLen+extraLen)
+				version = numpy.lib.format.read_magic(f)
+				if version == (1, 0):
+					(shape, fortran, dtype) = numpy.lib.format.read_array_header_1_0(f)
+				else:
+					(shape, fortran, dtype) = numpy.lib.format.read_array_header_2_0(f)
+				if dtype.hasobject or len(shape) == 0 or 0 in shape:
+					arrays[name] = numpy.lib.format.read_array(zf.open(info))
+				else:
+					arrays[name] = numpy.memmap(path, dtype=dtype, mode='r', offset=f.tell(),
+						shape=shape, order='F' if fortran else 'C')
+	return arrays
+
+# ===========================================================
+# Stack one column of many reports into a samples x genomes matrix over
+# the union of their genomes (sorted by name); a genome missing from a
+# report is 0 for that sample. Returns (genomes, matrix). With refIndex,
+# the reports must carry refIds and the columns are the references of the
+# index, in index order: no names are compared at all
+def aggregate_reports(paths, column='finalGuess', refIndex=None):
+	if column not in REPORT_COLUMNS:
+		raise ValueError("unknown report column: %s" % column)
+	reports = [load_report(p, [column]) for p in paths]
+	if refIndex is not None:
+		matrix = numpy.zeros((len(reports), len(refIndex)))
+		for (s, r) in enumerate(reports):
+			if 'refIds' not in r:
+				raise ValueError("report %s has no reference ids" % paths[s])
+			matrix[s, r['refIds']] = r[column]
+		return numpy.array(refIndex.names, dtype=numpy.string_), matrix
+	# samples aligned to the same reference share their genome list, so the
+	# union and the column positions are worked out once per distinct list
+	h_names = {}
+	for r in reports:
+		h_names.setdefault(r['genomes'].dtype.str+r['genomes'].tostring(), r['genomes'])
+	if h_names:
+		genomes = numpy.unique(numpy.concatenate(h_names.values()))
+	else:
+		genomes = numpy.array([], dtype=numpy.string_)
+	for (key, names) in h_names.items():
+		h_names[key] = numpy.searchsorted(genomes, names)
+	matrix = numpy.zeros((len(reports), len(genomes)))
+	for (s, r) in enumerate(reports):
+		matrix[s, h_names[r['genomes'].dtype.str+r['genomes'].tostring()]] = r[column]
+	return genomes, matrix
@@ -19,7 +19,12 @@
 #	along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import os
+import os, zlib, threading, Queue
+from itertools import chain
+try:
+	import pysam
+except ImportError:
+	pysam = None
 
 # ===========================================================
 def file_len(fname):
@@ -32,3 +37,216 @@ def ensure_dir(d):
 	if not os.path.exists(d):
 		os.makedirs(d)
 # ===========================================================
+# suffixes of the files open_file decompresses when reading
+compressedExts = ('.gz', '.bgz', '.bam')
+
+def is_compressed(fname):
+	return fname.endswith(compressedExts)
+
+# ===========================================================
+# open fname for reading or writing lines: .gz/.bgz files (gzip or bgzip,
+# i.e. any number of gzip members) are inflated or deflated by a
+# background thread, .bam files are read as sam text through pysam
+def open_file(fname, mode='r', compresslevel=1):
+	if fname.endswith('.gz') or fname.endswith('.bgz'):
+		if 'w' in mode:
+			return GzipLineWriter(fname, compresslevel)
+		return GzipLineReader(fname)
+	if fname.endswith('.bam') and 'w' not in mode:
+		return BamLineReader(fname)
+	return open(fname, mode)
+
+# ===========================================================
+# pass lines through, counting them into counts[key]
+def count_lines(lines, counts, key='lines'):
+	counts[key] = 0
+	for ln in lines:
+		counts[key] += 1
+		yield ln
+
+# ===========================================================
+# Background-thread gzip reader. zlib releases the GIL while it inflates,
+# so decompression of the next blocks overlaps with the caller parsing
+# the current ones; lines come out of per-block lists, without a python
+# readline per line as with gzip.GzipFile
+# ===========================================================
+class GzipLineReader(object):
+	def __init__(self, fname, blockSize=1<<20, queueBlocks=16):
+		self.name = fname
+		self.blockSize = blockSize
+		self.raw = open(fname, 'rb')
+		self.queue = Queue.Queue(queueBlocks)
+		self.error = None
+		self.closing = False
+		self.thread = threading.Thread(target=self._inflate)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _put(self, data):
+		while not self.closing:
+			try:
+				self.queue.put(data, timeout=0.1)
+				return
+			except Queue.Full:
+				pass
+
+	def _inflate(self):
+		try:
+			d = zlib.decompressobj(16+zlib.MAX_WBITS)
+			started = False
+			for chunk in iter(lambda: self.raw.read(self.blockSize), ''):
+				if self.closing:
+					break
+				started = True
+				data = d.decompress(chunk)
+				while d.unused_data:
+					# end of a gzip member (bgzip block): the rest is the next one
+					if data:
+						self._put(data)
+					rest = d.unused_data
+					d = zlib.decompressobj(16+zlib.MAX_WBITS)
+					data = d.decompress(rest)
+				if data:
+					self._put(data)
+			if started and not self.closing:
+				# zlib checks the CRC32/ISIZE trailer of a member it reaches
+				# the end of, but says nothing when the file stops before: a
+				# byte fed after a complete member is left unused, while an
+				# unfinished member takes it as more compressed data
+				d.decompress('\0')
+				if d.unused_data != '\0':
+					raise IOError("truncated gzip file")
+		except Exception as e:
+			self.error = e
+		self._put(None)
+
+	def _blocks(self):
+		tail = ''
+		while True:
+			data = self.queue.get()
+			if data is None:
+				break
+			lines = (tail+data).split('\n')
+			tail = lines.pop()
+			yield [ln+'\n' for ln in lines]
+		if self.error is not None:
+			raise IOError("%s: %s" % (self.name, self.error))
+		if tail:
+			yield [tail]
+
+	def __iter__(self):
+		return chain.from_iterable(self._blocks())
+
+	def close(self):
+		self.closing = True
+		self.thread.join()
+		self.raw.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+# ===========================================================
+# Background-thread gzip writer: written text is collected into blocks
+# that a thread deflates (one gzip member) and writes out
+# ===========================================================
+class GzipLineWriter(object):
+	def __init__(self, fname, compresslevel=1, blockSize=1<<20, queueBlocks=16):
+		self.name = fname
+		self.blockSize = blockSize
+		self.raw = open(fname, 'wb')
+		self.compresslevel = compresslevel
+		self.queue = Queue.Queue(queueBlocks)
+		self.buf = []
+		self.bufLen = 0
+		self.error = None
+		self.thread = threading.Thread(target=self._deflate)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _deflate(self):
+		try:
+			c = zlib.compressobj(self.compresslevel, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+			for data in iter(self.queue.get, None):
+				self.raw.write(c.compress(data))
+			self.raw.write(c.flush())
+		except Exception as e:
+			self.error = e
+			# keep taking blocks so that the writer never blocks
+			for data in iter(self.queue.get, None):
+				pass
+
+	def write(self, data):
+		self.buf.append(data)
+		self.bufLen += len(data)
+		if self.bufLen >= self.blockSize:
+			self.queue.put(''.join(self.buf))
+			self.buf = []
+			self.bufLen = 0
+
+	def writelines(self, lines):
+		for ln in lines:
+			self.write(ln)
+
+	def close(self):
+		if self.raw.closed:
+			return
+		if self.buf:
+			self.queue.put(''.join(self.buf))
+			self.buf = []
+		self.queue.put(None)
+		self.thread.join()
+		self.raw.close()
+		if self.error is not None:
+			raise IOError("%s: %s" % (self.name, self.error))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+# ===========================================================
+# BAM input as sam text lines (header first), through pysam
+# ===========================================================
+class BamLineReader(object):
+	def __init__(self, fname):
+		if pysam is None:
+			raise ImportError("reading %s requires pysam, which is not installed" % fname)
+		self.bam = pysam.AlignmentFile(fname, 'rb')
+
+	def __iter__(self):
+		bam = self.bam
+		header = str(bam.header)
+		for ln in header.splitlines():
+			yield ln+'\n'
+		for rec in bam.fetch(until_eof=True):
+			if hasattr(rec, 'to_string'):
+				yield rec.to_string()+'\n'
+			else:
+				yield rec.tostring(bam)+'\n'
+
+	def close(self):
+		self.bam.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+# ===========================================================
+# yield the lines of a stream while also writing them to out, which is
+# closed once the stream is exhausted
+def tee_lines(lines, out, bufLines=4096):
+	buf = []
+	for ln in lines:
+		buf.append(ln)
+		if len(buf) == bufLines:
+			out.write(''.join(buf))
+			buf = []
+		yield ln
+	out.write(''.join(buf))
+	out.close()
+# ===========================================================
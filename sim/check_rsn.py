@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+File: check_rsn.py
+
+Description: check the numpy skew-normal sampler of pbcsim (pbcsim.rsn)
+against the skew-normal distribution of the R package sn, whose
+location/scale/shape parametrization it follows.  For every setting,
+draws from rsn are compared to reference quantiles of the skew-normal
+(the cdf, from numerical integration of the density
+2/scale * phi(z) * Phi(shape * z), z = (x - location) / scale) by the
+KS statistic and by the largest quantile difference.  Exits with
+status 1 if any setting is out of tolerance.
+
+"""
+
+import os
+import sys
+import math
+import argparse
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import pbcsim
+
+
+# (location, scale, shape): the pbcsim defaults (--average, --spread,
+# --skew) and a spread of other shapes
+SETTINGS = [
+    (400, 50, -5),
+    (250, 30, -5),
+    (0, 1, 0),
+    (100, 10, 3),
+    (400, 50, -20)
+]
+
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+
+def get_args():
+    """Get arguments from CLI"""
+    parser = argparse.ArgumentParser(
+            description="""Check pbcsim.rsn against skew-normal reference quantiles""")
+    parser.add_argument(
+            "--draws",
+            type=int,
+            default=1000000,
+            help="""The number of draws per setting"""
+        )
+    parser.add_argument(
+            "--seed",
+            type=int,
+            default=1,
+            help="""The random seed"""
+        )
+    parser.add_argument(
+            "--quantile-tolerance",
+            type=float,
+            default=0.02,
+            help="""The largest allowed quantile difference, in units of scale"""
+        )
+    return parser.parse_args()
+
+
+def reference_cdf(location, scale, shape, points=200001):
+    """The skew-normal cdf on a grid of location +/- 8 scale, by the
+    trapezoidal rule over the density"""
+    x = numpy.linspace(location - 8. * scale, location + 8. * scale, points)
+    z = (x - location) / float(scale)
+    erf = numpy.vectorize(math.erf)
+    density = 2. / scale * numpy.exp(-z * z / 2.) / math.sqrt(2. * math.pi) * \
+        0.5 * (1. + erf(shape * z / math.sqrt(2.)))
+    cdf = numpy.zeros(points)
+    cdf[1:] = numpy.cumsum((density[1:] + density[:-1]) / 2. * numpy.diff(x))
+    return x, cdf
+
+
+def check(location, scale, shape, draws, rng):
+    """(KS statistic, largest quantile difference / scale) of draws from
+    pbcsim.rsn against the reference cdf"""
+    x, cdf = reference_cdf(location, scale, shape)
+    sample = numpy.sort(pbcsim.rsn(draws, location, scale, shape, rng))
+    empirical = numpy.arange(1, draws + 1) / float(draws)
+    reference = numpy.interp(sample, x, cdf)
+    ks = max(numpy.max(empirical - reference), numpy.max(reference - empirical + 1. / draws))
+    expected = numpy.interp(QUANTILES, cdf, x)
+    observed = numpy.percentile(sample, [100. * q for q in QUANTILES])
+    return ks, numpy.max(numpy.abs(expected - observed)) / scale
+
+
+def main():
+    args = get_args()
+    rng = numpy.random.RandomState(args.seed)
+    # the KS critical value at the 1% level
+    critical = 1.628 / math.sqrt(args.draws)
+    failed = 0
+    for location, scale, shape in SETTINGS:
+        ks, quantile = check(location, scale, shape, args.draws, rng)
+        ok = ks < critical and quantile < args.quantile_tolerance
+        if not ok:
+            failed += 1
+        print "location={:<6} scale={:<4} shape={:<4} KS={:.5f} (< {:.5f}) quantile diff={:.4f} (< {}) {}".format(
+            location, scale, shape, ks, critical, quantile, args.quantile_tolerance,
+            "ok" if ok else "FAILED")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
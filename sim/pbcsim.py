@@ -8,21 +8,33 @@ Copyright (c) 2009 Brant Faircloth. All rights reserved.
 """
 
 import pdb
-import re
 import os
 import sys
+import math
 import numpy 
 import random
+import string
+import csv
+import gzip
+import time
 import optparse
 import itertools
+import multiprocessing
 from Bio import SeqIO
 from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
 from Bio.Alphabet import SingleLetterAlphabet
-# make sure we use sqlite supporting foreign keys
-from pysqlite2 import dbapi2 as sqlite3
-# use rpy for a quicky skew-normal distribution
-import rpy2.robjects as robjects
+# make sure we use sqlite supporting foreign keys (the sqlite3 of any recent
+# python does too)
+try:
+    from pysqlite2 import dbapi2 as sqlite3
+except ImportError:
+    import sqlite3
+# parquet output of the reads rows is optional
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 
 ## To generate a random sample of species:
@@ -69,6 +81,15 @@ def interface():
     p.add_option('--meters', '-m', dest = 'meters', action='store', \
     type='float', default = 5.0,
     help='Distance from the point to sample')
+    p.add_option('--plots', dest = 'plots', action='store', \
+    type='string', default = '../BCI2005.sqlite', \
+    help='Path to the plot database from which we pick species', \
+    metavar='FILE')
+    p.add_option('--spatial', dest = 'spatial', action='store', \
+    type='choice', choices = ['grid', 'rtree', 'scan'], default = 'grid',
+    help='How species around a point are found in the plot database: an \
+    in-memory grid of the alive stems, an R*Tree table in the database, or \
+    a scan of the plot table per core')
     p.add_option('--average', '-a', dest = 'average', action='store', \
     type='int', default = 400,
     help='Average read length')
@@ -78,6 +99,28 @@ def interface():
     p.add_option('--skew', '-k', dest = 'skew', action='store', \
     type='int', default = -5,
     help='Skew of average read length')
+    p.add_option('--processes', '-j', dest = 'processes', action='store', \
+    type='int', default = multiprocessing.cpu_count(),
+    help='The number of worker processes simulating cores')
+    p.add_option('--seed', dest = 'seed', action='store', \
+    type='int', default = None,
+    help='Random seed; the same seed gives the same simulation')
+    p.add_option('--batch', '-b', dest = 'batch', action='store', \
+    type='int', default = 50000,
+    help='The number of rows written to the database per transaction')
+    p.add_option('--journal', dest = 'journal', action='store', \
+    type='string', default = 'WAL',
+    help='The sqlite journal mode of the database (e.g. WAL, DELETE)')
+    p.add_option('--synchronous', dest = 'synchronous', action='store', \
+    type='string', default = 'NORMAL',
+    help='The sqlite synchronous setting of the database (OFF, NORMAL, FULL)')
+    p.add_option('--read-rows', dest = 'read_rows', action='store', \
+    type='choice', choices = ['sqlite', 'csv', 'parquet'], default = 'sqlite',
+    help='Where the per-read rows go: the reads table, or a csv or parquet \
+    file next to the database')
+    p.add_option('--gzip', '-z', dest = 'gzip', action='store_true', \
+    default = False,
+    help='Write gzip-compressed core fasta files')
     (options,arg) = p.parse_args()
     if not options.input:
         p.print_help()
@@ -96,10 +139,10 @@ def length(handle):
             count += 1
     return count
 
-def species_per_core(mean, sd, count):
+def species_per_core(mean, sd, count, rng=numpy.random):
     '''compute the number of species per virtual soil core'''
     #pdb.set_trace()
-    return abs(numpy.random.normal(mean, sd, count).round())
+    return abs(rng.normal(mean, sd, count).round())
 
 def sequence_dictionary(files, remove=True):
     '''generate a dictionary holding sequence data from multiple files'''
@@ -121,134 +164,253 @@ def sequence_dictionary(files, remove=True):
     print 'removed', s_count - len(all_seqs), 'sequences w/o all barcodes'
     return all_seqs
 
-def species_sampler(seq_dict, sample):
+def species_sampler(seq_dict, sample, rng=numpy.random):
     '''randomly select some sequences (uniform) from a sequence dict'''
     # sample a list of numbers w/o replacement
-    rsample = random.sample(xrange(len(seq_dict)), int(sample))
+    rsample = set(rng.permutation(len(seq_dict))[:int(sample)].tolist())
     seq_sample = {}
-    for seq_index, seq in enumerate(seq_dict):
+    for seq_index, seq in enumerate(sorted(seq_dict)):
         if seq_index in rsample:
             seq_sample[seq] = seq_dict[seq]
     #pdb.set_trace()
     return seq_sample
 
-def root_freq(sample, roots):
+def root_freq(sample, roots, rng=numpy.random):
     '''compute the true frequency of sequences in solution'''
-    return (numpy.random.mtrand.dirichlet([1] * sample) * roots).round()
+    return (rng.dirichlet([1] * sample) * roots).round()
+
+# complement of the IUPAC DNA codes, as used by Bio.Seq
+COMPLEMENT = string.maketrans('ACGTMRWSYKVHDBNacgtmrwsykvhdbn',
+    'TGCAKYWSRMBDHVNtgcakywsrmbdhvn')
+
+def reverse_complement(seq):
+    '''reverse complement of a DNA string'''
+    return seq.translate(COMPLEMENT)[::-1]
+
+def join_reads(seqs):
+    '''concatenate sequences into one byte array, returning it with the
+    offsets of the sequences in it (one more than there are sequences)'''
+    seqs = [str(seq) for seq in seqs]
+    starts = numpy.zeros(len(seqs) + 1, dtype = 'int64')
+    numpy.cumsum([len(seq) for seq in seqs], out = starts[1:])
+    return numpy.frombuffer(''.join(seqs), dtype = 'uint8'), starts
 
-class Error():
+def split_reads(buf, starts):
+    '''the inverse of join_reads, giving strings'''
+    joined = buf.tostring()
+    bounds = starts.tolist()
+    return [joined[bounds[k]:bounds[k + 1]] for k in xrange(len(bounds) - 1)]
+
+def splice(buf, starts, keep, ins_pos, ins_base, ins_read):
+    '''apply all the indels of a batch of joined reads at once: drop the
+    bases where keep is False and put ins_base[k] in front of position
+    ins_pos[k] (sorted), as part of read ins_read[k].  Returns the new
+    buffer and read offsets'''
+    n = len(starts) - 1
+    deleted = numpy.flatnonzero(~keep)
+    lengths = numpy.diff(starts) \
+        - numpy.bincount(numpy.searchsorted(starts, deleted, 'right') - 1, minlength = n) \
+        + numpy.bincount(ins_read, minlength = n)
+    new_starts = numpy.zeros(n + 1, dtype = 'int64')
+    numpy.cumsum(lengths, out = new_starts[1:])
+    new_buf = numpy.insert(buf, ins_pos, ins_base)
+    new_buf = new_buf[numpy.insert(keep, ins_pos, True)]
+    return new_buf, new_starts
+
+class Error(object):
     '''A generic class for generating sequence errors in PCR products
-    and sequencing reads'''
-    def __init__(self, **kwargs):
+    and sequencing reads.  Errors are added to whole batches of reads at
+    once: all error positions of a batch are drawn up front and applied
+    in a single splice.  rng is the random number generator to draw from
+    (a numpy RandomState, or the numpy.random module); size is the
+    expected number of reads, for which the per-read error statistics are
+    preallocated'''
+    def __init__(self, rng=numpy.random, size=1024, **kwargs):
         self.kwargs = kwargs
-        if 'h_rate' in self.kwargs.keys():
-            #self.approx_homo_error_rate = sum(numpy.random.poisson(self.kwargs['h_rate'], 10000) > 0)/10000.
-            self._homogen()
-        #if rate in self.kwargs.keys():
-        self.homo_error_relative = numpy.array([])
-        self.homo_error_overall = numpy.array([])
-        self.other_error_overall = numpy.array([])
-    
-    def _homogen(self):
-        homo = ''
-        for b in ['Aa','Cc', 'Gg', 'Tt']:
-            homo += (('[%s]{%s,}|') % (b, self.kwargs['h_length'] + 1))
-        homo = homo[:-1]
-        #pdb.set_trace()
-        self.re_homo = re.compile(homo)
-    
+        self.rng = rng
+        # per-read error rates, in preallocated arrays that are doubled
+        # when full; see the properties below
+        self.stats = {}
+        self.filled = {}
+        for name in ['homo_error_relative', 'homo_error_overall', 'other_error_overall']:
+            self.stats[name] = numpy.empty(max(size, 1))
+            self.filled[name] = 0
+
+    def _record(self, name, values):
+        filled = self.filled[name]
+        array = self.stats[name]
+        if filled + len(values) > len(array):
+            grown = numpy.empty(max(2 * len(array), filled + len(values)))
+            grown[:filled] = array[:filled]
+            array = self.stats[name] = grown
+        array[filled:filled + len(values)] = values
+        self.filled[name] = filled + len(values)
+
+    @property
+    def homo_error_relative(self):
+        '''homopolymer errors per homopolymer run, for every read'''
+        return self.stats['homo_error_relative'][:self.filled['homo_error_relative']]
+
+    @property
+    def homo_error_overall(self):
+        '''homopolymer errors per base, for every read'''
+        return self.stats['homo_error_overall'][:self.filled['homo_error_overall']]
+
+    @property
+    def other_error_overall(self):
+        '''other (non-homopolymer) errors per base, for every read'''
+        return self.stats['other_error_overall'][:self.filled['other_error_overall']]
+
+    def _error_positions(self, length, rate):
+        '''positions of a Bernoulli(rate) process over length bases, drawn
+        as geometric gaps between errors rather than one draw per base'''
+        if length == 0 or rate <= 0:
+            return numpy.zeros(0, dtype = 'int64')
+        expected = length * rate
+        pos = numpy.cumsum(self.rng.geometric(rate, int(expected + 6 * math.sqrt(expected) + 16))) - 1
+        while pos[-1] < length:
+            more = numpy.cumsum(self.rng.geometric(rate, int(expected + 16))) + pos[-1]
+            pos = numpy.concatenate((pos, more))
+        return pos[pos < length]
+
+    def homopolymer_batch(self, seqs):
+        '''add homopolymer indels to a list of sequences, returning strings'''
+        buf, starts = join_reads(seqs)
+        n = len(starts) - 1
+        # homopolymer runs (of more than h_length bases, case-insensitive),
+        # never crossing from one read into the next
+        upper = buf & 0xDF
+        brk = numpy.ones(len(buf), dtype = bool)
+        brk[1:] = upper[1:] != upper[:-1]
+        brk[starts[:-1][numpy.diff(starts) > 0]] = True
+        run_start = numpy.flatnonzero(brk)
+        run_end = numpy.append(run_start[1:], len(buf))
+        runs = (run_end - run_start > self.kwargs['h_length']) & \
+            numpy.in1d(upper[run_start], numpy.frombuffer('ACGT', dtype = 'uint8'))
+        m_start = run_start[runs]
+        m_end = run_end[runs]
+        m_read = numpy.searchsorted(starts, m_start, 'right') - 1
+        # is it insertion or deletion (multinomial) with p = 0.5
+        insertions = self.rng.binomial(1, 0.5, len(m_start)).astype(bool)
+        # let's treat the homopolymer error creation as a poisson process
+        # so that we can decide both whether there is error at a particular
+        # homopolymer run and **how** much error there is (i,e. an indel
+        # of 0,1,2,3...,n bases).  We'll use the binomial above to determine
+        # if we have an insertion or deletion
+        errors = self.rng.poisson(self.kwargs['h_rate'], len(m_start))
+        # a deletion removes the last bases of the run, if it is long enough
+        dele = ~insertions & (errors > 0) & (m_end - m_start > errors)
+        keep = numpy.ones(len(buf), dtype = bool)
+        keep[ranges(m_end[dele] - errors[dele], errors[dele])] = False
+        # an insertion repeats the first base of the run at its end
+        ins = insertions & (errors > 0)
+        buf, new_starts = splice(buf, starts, keep, numpy.repeat(m_end[ins], errors[ins]),
+            numpy.repeat(buf[m_start[ins]], errors[ins]), numpy.repeat(m_read[ins], errors[ins]))
+        per_read = numpy.bincount(m_read, weights = errors, minlength = n)
+        matches = numpy.bincount(m_read, minlength = n)
+        new_lengths = numpy.diff(new_starts)
+        has = matches > 0
+        overall = numpy.zeros(n)
+        relative = numpy.zeros(n)
+        # a read left without bases has no per-base rate: it counts as 0
+        rated = has & (new_lengths > 0)
+        overall[rated] = per_read[rated] / new_lengths[rated]
+        relative[has] = per_read[has] / matches[has]
+        self._record('homo_error_overall', overall)
+        self._record('homo_error_relative', relative)
+        return split_reads(buf, new_starts)
+
+    def other_batch(self, seqs):
+        '''add other (non-homopolymer) indels to a list of sequences,
+        returning strings'''
+        buf, starts = join_reads(seqs)
+        n = len(starts) - 1
+        # lets treat "regular errors" as a binomial process
+        pos = self._error_positions(len(buf), self.kwargs['rate'])
+        read = numpy.searchsorted(starts, pos, 'right') - 1
+        # see if it's an insertion or deletion
+        insertions = self.rng.binomial(1, 0.5, len(pos)).astype(bool)
+        keep = numpy.ones(len(buf), dtype = bool)
+        keep[pos[~insertions]] = False
+        # just pick a random base and insert it
+        new_bases = numpy.frombuffer('ACGT', dtype = 'uint8')[self.rng.randint(0, 4, insertions.sum())]
+        buf, new_starts = splice(buf, starts, keep, pos[insertions], new_bases, read[insertions])
+        per_read = numpy.bincount(read, minlength = n).astype(float)
+        new_lengths = numpy.diff(new_starts)
+        # a read whose deletions took all its bases has no per-base rate:
+        # it counts as 0
+        has = (per_read > 0) & (new_lengths > 0)
+        overall = numpy.zeros(n)
+        overall[has] = per_read[has] / new_lengths[has]
+        self._record('other_error_overall', overall)
+        return split_reads(buf, new_starts)
+
     def homopolymer(self, seq):
-        matches = tuple(re.finditer(self.re_homo, str(seq)))
-        seq_list = list(str(seq)) 
-        if matches:
-            #for m in matches:
-            #    print m.group()
-            # is it insertion or deletion (multinomial) with p = 0.5
-            insertions = numpy.random.binomial(1,0.5, len(matches))
-            # let's treat the homopolymer error creation as a poisson process
-            # so that we can decide both whether there is error at a particular
-            # homopolymer run and **how** much error there is (i,e. an indel
-            # of 0,1,2,3...,n bases).  We'll use the binomial above to determine
-            # if we have an insertion or deletion
-            errors = numpy.random.poisson(self.kwargs['h_rate'], len(matches))
-            # go in reverse
-            for pos, m in enumerate(matches[::-1]):
-                if insertions[pos] and errors[pos]:
-                    #pdb.set_trace()
-                    seq_list = seq_list[:m.start()] + list(m.group() + m.group()[0] * errors[pos]) + seq_list[m.end():]
-                elif not insertions[pos] and errors[pos]:
-                    if m.end() - m.start() > errors[pos]:
-                        seq_list = seq_list[:m.start()] + list(m.group()[:len(m.group()) - errors[pos]]) + seq_list[m.end():]
-                    else:
-                        pass
-                else:
-                    pass
-            #pdb.set_trace()
-            self.homo_error_overall = numpy.append(self.homo_error_overall, float(sum(errors))/len(seq_list))
-            self.homo_error_relative = numpy.append(self.homo_error_relative, float(sum(errors))/len(matches)) 
-        else:
-            self.homo_error_overall = numpy.append(self.homo_error_overall, 0.)
-            self.homo_error_relative = numpy.append(self.homo_error_relative, 0.)
-        return Seq(''.join(seq_list), SingleLetterAlphabet())
-        #print '\n'
-        #pdb.set_trace()
+        return Seq(self.homopolymer_batch([seq])[0], SingleLetterAlphabet())
 
     def other(self, seq):
-        seq_list = list(str(seq))
-        # lets treat "regular errors" as a binomial process
-        errors = numpy.random.binomial(1, self.kwargs['rate'], len(seq_list))
-        if 1 not in errors:
-            self.other_error_overall = numpy.append(self.other_error_overall, 0.)
-        else:
-            bases = {0:'A',1:'C',2:'G',3:'T'}
-            for pos, e in enumerate(seq_list[::-1]):
-                if errors[pos] == 1:
-                    #pdb.set_trace()
-                    # see if it's an insertion or deletion
-                    if numpy.random.binomial(1,0.5) and errors[pos]:
-                        # just pick a random base and insert it
-                        new_base = bases[numpy.random.random_integers(0,3)]
-                        seq_list = seq_list[:pos] + [new_base] + seq_list[pos:]
-                    else:
-                        seq_list = seq_list[:pos] + seq_list[pos + 1:]
-            #pdb.set_trace()
-            self.other_error_overall = numpy.append(self.other_error_overall, float(sum(errors))/len(seq_list))
-        return Seq(''.join(seq_list), SingleLetterAlphabet())
+        return Seq(self.other_batch([seq])[0], SingleLetterAlphabet())
 
 
-def read_lengths(robj, seq, mean, sd, skew = -5):
-    '''sample from the entire length of the read, in both
+def ranges(starts, lengths):
+    '''the positions of the ranges [starts[k], starts[k] + lengths[k])'''
+    offsets = numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+    return numpy.repeat(starts, lengths) + numpy.arange(offsets.size) - offsets
+
+
+def rsn(n, location = 0., scale = 1., shape = 0., rng = numpy.random):
+    '''n draws from the skew-normal distribution, parametrized as rsn of
+    the R package sn (xi = location, omega = scale, alpha = shape): the
+    sign of a standard normal u0 picks u1 or -u1, where u1 is correlated
+    with u0 by delta = shape / sqrt(1 + shape^2)'''
+    delta = shape / math.sqrt(1. + shape ** 2)
+    u0 = rng.standard_normal(n)
+    u1 = delta * u0 + math.sqrt(1. - delta ** 2) * rng.standard_normal(n)
+    return location + scale * numpy.where(u0 >= 0, u1, -u1)
+
+def read_lengths(seqs, mean, sd, skew = -5, rng = numpy.random):
+    '''sample from the entire length of the reads, in both
     directions, returning the forward (potentially partial) read and the
-    reverse (potentially partial) read (the revcomp)'''
+    reverse (potentially partial) read (the revcomp) of every sequence, 
+    one after the other'''
     #l,r = numpy.random.normal(mean, sd, 2).round()
-    l,r = robj.rsn(n=2, location=mean, scale = sd, shape = skew)
-    return (seq[:int(l)], seq[len(seq)-int(r):].reverse_complement())
+    lengths = rsn(2 * len(seqs), location = mean, scale = sd, shape = skew, rng = rng).astype(int).tolist()
+    reads = []
+    for k, seq in enumerate(seqs):
+        seq = str(seq)
+        l, r = lengths[2 * k], lengths[2 * k + 1]
+        reads.append(seq[:l])
+        reads.append(reverse_complement(seq[len(seq)-r:]))
+    return reads
 
 
-def dna_sample(root_freq, sampling_freq):
+def dna_sample(root_freq, sampling_freq, rng=numpy.random, shuffle=True):
     '''since adding DNA to PCR reactions is basically a sampling process,
     recreate that process by sampling the available pool of species - i,e.
     we are probably going to drop some low-count species here, a process at
-    which we're interesting in looking'''
-    root_pop = numpy.array([], dtype = 'int64')
-    # using our relative freqs from the dirichlet, expand those counts to give
-    # the root population we have in our virtual sample
-    for pos,count in enumerate(root_freq):
-        root_pop = numpy.append(root_pop, numpy.array([pos] * count))
-    # NOTE:  we could probably just numpy.random.shuffle() and then slice
-    # we're assuming we draw sampling_freq of the population when we pipet
-    # so, we'll randomly sample, without replacement, the index values of the
-    # elements created in the root_pop array that is above
-    root_pop_sample = numpy.array(random.sample(xrange(len(root_pop)), int(sampling_freq*len(root_pop))))
-    #pdb.set_trace()
-    root_sample = root_pop[root_pop_sample]
-    # we'll reform the root_freq post sampling
-    post_sample_counts = numpy.zeros(len(root_freq))
-    for r in root_sample:
-        post_sample_counts[r] += 1
-    #pdb.set_trace()
-    # now, we'll reindex the root_pop array and return our sampled
-    # root population
+    which we're interesting in looking.  Returns the sampled individuals
+    (their species indexes, in random order unless shuffle is False) and the
+    sampled count of every species'''
+    counts = numpy.asarray(root_freq).astype('int64')
+    # we're assuming we draw sampling_freq of the population when we pipet,
+    # without replacement: that is a multivariate hypergeometric draw over
+    # the counts, done one species at a time as a hypergeometric draw from
+    # what is left of the population
+    remaining = int(counts.sum())
+    draws = int(sampling_freq * remaining)
+    post_sample_counts = numpy.zeros(len(counts))
+    for pos, count in enumerate(counts.tolist()):
+        if draws == 0:
+            break
+        remaining -= count
+        if count > 0:
+            drawn = rng.hypergeometric(count, remaining, draws) if remaining > 0 else draws
+            post_sample_counts[pos] = drawn
+            draws -= drawn
+    # expand the counts to the individuals of our sampled root population
+    root_sample = numpy.repeat(numpy.arange(len(counts)), post_sample_counts.astype('int64'))
+    if shuffle:
+        root_sample = rng.permutation(root_sample)
     return root_sample, post_sample_counts
 
 def tables(c):
@@ -284,19 +446,129 @@ def tables(c):
     )''')      
     # removed FOREIGN KEY(id) REFERENCES cores(id)
 
-def insert_read_row(c, core_index, locus, individual_index, spp, reads, h_error, s_error):
-    '''docstring for insert_read_row'''
-    for i, side in enumerate(['l','r']):
-        c.execute('''INSERT INTO reads (id, locus, indiv_id, side, spp, read_length, 
-        homo_error, other_error, all_error) VALUES (?,?,?,?,?,?,?,?,?)''', 
-        (core_index, locus, individual_index, side, spp, len(reads[i]), 
-        h_error[i].round(3), s_error[i].round(3), 
-        (h_error[i]+s_error[i]).round(3)))
+def pragmas(c, journal, synchronous):
+    '''set the journal mode and synchronous setting of the database'''
+    c.execute('''PRAGMA journal_mode=%s''' % journal)
+    c.execute('''PRAGMA synchronous=%s''' % synchronous)
+
+def indexes(c):
+    '''index the reads by core, once they are all loaded'''
+    c.execute('''CREATE INDEX reads_core ON reads (id, locus)''')
+
+CORE_COLUMNS = ['id', 'locus', 'true_count', 'sample_count', 'homo_error', 'other_error', 'all_error']
+READ_COLUMNS = ['id', 'locus', 'indiv_id', 'side', 'spp', 'read_length', 'homo_error', 
+    'other_error', 'all_error']
 
-def write_reads(i, locus, side, fsa, core_index, individual_index, spp, reads, h_error, s_error):
-    '''generator to hold the sequence reads for efficient writing'''
-    header = '%s_%s_%s_%s_%s' % (core_index, individual_index, spp.replace(' ','_'), side, locus)
-    yield SeqRecord(reads[i], id = header, name = header, description = header)
+def read_rows(core_index, locus, names, lengths, h_error, s_error):
+    '''the reads table rows of one locus of a core: two (l and r) for
+    every individual'''
+    lengths = lengths.ravel().tolist()
+    homo = h_error.round(3).ravel().tolist()
+    other = s_error.round(3).ravel().tolist()
+    total = (h_error + s_error).round(3).ravel().tolist()
+    rows = []
+    for k in xrange(2 * len(names)):
+        rows.append((core_index, locus, k // 2, 'lr'[k % 2], names[k // 2], lengths[k], 
+            homo[k], other[k], total[k]))
+    return rows
+
+class RowWriter(object):
+    '''Buffer the rows of the cores and reads tables and write them with
+    executemany, committing every batch rows.  With side ('csv' or
+    'parquet') the reads rows go to side_path instead of the database'''
+    def __init__(self, con, batch=50000, side=None, side_path=None):
+        self.con = con
+        self.cur = con.cursor()
+        self.batch = batch
+        self.side = side
+        self.rows = {'cores':[], 'reads':[]}
+        self.pending = 0
+        self.written = 0
+        self.seconds = 0.
+        self.side_file = self.csv = self.parquet = None
+        if side == 'csv':
+            self.side_file = open(side_path, 'wb')
+            self.csv = csv.writer(self.side_file)
+            self.csv.writerow(READ_COLUMNS)
+        elif side == 'parquet':
+            if pyarrow is None:
+                raise ImportError("parquet output requires pyarrow, which is not installed")
+            self.side_path = side_path
+
+    def add(self, table, rows):
+        self.rows[table].extend(rows)
+        self.pending += len(rows)
+        if self.pending >= self.batch:
+            self.flush()
+
+    def flush(self):
+        '''write the buffered rows in one transaction (cores first, for
+        the foreign key of the reads)'''
+        start = time.time()
+        if self.rows['cores']:
+            self.cur.executemany('''INSERT INTO cores (%s) VALUES (%s)''' % 
+                (', '.join(CORE_COLUMNS), ','.join('?' * len(CORE_COLUMNS))), self.rows['cores'])
+        reads = self.rows['reads']
+        if reads:
+            if self.side == 'csv':
+                self.csv.writerows(reads)
+            elif self.side == 'parquet':
+                table = pyarrow.Table.from_arrays([pyarrow.array(list(column)) for column in zip(*reads)], 
+                    names = READ_COLUMNS)
+                if self.parquet is None:
+                    self.parquet = pyarrow.parquet.ParquetWriter(self.side_path, table.schema)
+                self.parquet.write_table(table)
+            else:
+                self.cur.executemany('''INSERT INTO reads (%s) VALUES (%s)''' % 
+                    (', '.join(READ_COLUMNS), ','.join('?' * len(READ_COLUMNS))), reads)
+        self.con.commit()
+        self.seconds += time.time() - start
+        self.written += self.pending
+        self.rows = {'cores':[], 'reads':[]}
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        if self.side_file is not None:
+            self.side_file.close()
+        if self.parquet is not None:
+            self.parquet.close()
+        self.cur.close()
+
+def read_header(core_index, individual_index, spp, side, locus):
+    '''the fasta header of a read'''
+    return '%s_%s_%s_%s_%s' % (core_index, individual_index, spp.replace(' ','_'), side, locus)
+
+class FastaWriter(object):
+    '''Write fasta records as they come (lines of width bases, as
+    SeqIO), collecting them in a buffer that is written out whenever it
+    holds more than size bytes.  Gzip-compressed when compress is set'''
+    def __init__(self, path, compress=False, width=60, size=1 << 20):
+        if compress:
+            self.handle = gzip.open(path, 'wb', 6)
+        else:
+            self.handle = open(path, 'wb')
+        self.width = width
+        self.size = size
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, header, seq):
+        lines = [seq[k:k + self.width] for k in xrange(0, len(seq), self.width)]
+        record = '>%s\n%s\n' % (header, '\n'.join(lines)) if lines else '>%s\n' % header
+        self.buffer.append(record)
+        self.buffered += len(record)
+        if self.buffered > self.size:
+            self.flush()
+
+    def flush(self):
+        self.handle.write(''.join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        self.handle.close()
 
 def core_map(core_species):
     m = {}
@@ -324,132 +596,279 @@ def species_picker(seq_dict, species, missing):
             #print '%s not in barcodes' % sp[0]
     return new, missing
 
-def species_getter(bcur, dist):
+def random_points(count, rng=numpy.random):
+    '''choose count random points (x in [0,1000), y in [0,500)) in the plot'''
+    x = rng.uniform(low=0, high=1000, size=count)
+    y = rng.uniform(low=0, high=500, size=count)
+    return x, y
+
+def species_getter(bcur, x, y, dist):
     '''get species surrounding a point dist m away where the point is 
     indexed by x and y coordinates'''
-    # choose a random (x) point in space from [0,999)
-    x = numpy.random.uniform(low=0, high=1000, size=1)
-    # choose a random (y) point in space from [0,999)
-    y = numpy.random.uniform(low=0, high=500, size=1)
-    # get x points ± dist from x
-    xs = rect_dist(x, dist)
-    # get y points ± dist from y
-    ys = rect_dist(y, dist)
-    results = []
+    # get x points +/- dist from x
+    xs = rect_dist(x, dist).ravel()
+    # get y points +/- dist from y
+    ys = rect_dist(y, dist).ravel()
     bcur.execute('''SELECT distinct(Latin) FROM plot where gx 
         between ? and ? and gy between ? and ? and Status = "alive"''', \
-        (xs[0][0], xs[1][0], ys[0][0], ys[1][0]))
+        (xs[0], xs[1], ys[0], ys[1]))
+    return bcur.fetchall()
+
+def rtree(bcur):
+    '''materialize an R*Tree of the alive stems of the plot table (once)'''
+    bcur.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS plot_rtree USING 
+        rtree(id, min_x, max_x, min_y, max_y)''')
+    bcur.execute('''SELECT count(*) FROM plot_rtree''')
+    if bcur.fetchone()[0] == 0:
+        bcur.execute('''INSERT INTO plot_rtree SELECT rowid, gx, gx, gy, gy FROM plot 
+            WHERE Status = "alive" AND gx IS NOT NULL AND gy IS NOT NULL''')
+
+def rtree_species_getter(bcur, x, y, dist):
+    '''species_getter through the R*Tree; its 32-bit boxes are only used to
+    find candidates, which are checked against the plot table'''
+    xs = rect_dist(x, dist).ravel()
+    ys = rect_dist(y, dist).ravel()
+    bcur.execute('''SELECT distinct(plot.Latin) FROM plot_rtree JOIN plot ON 
+        plot.rowid = plot_rtree.id WHERE plot_rtree.max_x >= ? AND plot_rtree.min_x <= ? 
+        AND plot_rtree.max_y >= ? AND plot_rtree.min_y <= ? AND plot.gx between ? and ? 
+        AND plot.gy between ? and ?''', (xs[0] - 1, xs[1] + 1, ys[0] - 1, ys[1] + 1, 
+        xs[0], xs[1], ys[0], ys[1]))
     return bcur.fetchall()
 
+class StemIndex(object):
+    '''The alive stems of the plot table, loaded once and bucketed in a
+    grid of cell x cell squares, so that the species around a point only
+    need a look at the stems of the cells its square overlaps'''
+    def __init__(self, bcur, cell=5.0):
+        bcur.execute('''SELECT gx, gy, Latin FROM plot WHERE Status = "alive" 
+            AND gx IS NOT NULL AND gy IS NOT NULL''')
+        stems = bcur.fetchall()
+        self.cell = float(cell)
+        self.names = []
+        codes = {}
+        sp = numpy.zeros(len(stems), dtype = 'int64')
+        for k, stem in enumerate(stems):
+            sp[k] = codes.setdefault(stem[2], len(codes))
+            if sp[k] == len(self.names):
+                self.names.append(stem[2])
+        gx = numpy.array([stem[0] for stem in stems], dtype = float)
+        gy = numpy.array([stem[1] for stem in stems], dtype = float)
+        del stems
+        # stems sorted by grid cell, with the offsets of every cell
+        self.x0 = gx.min() if len(gx) else 0.
+        self.y0 = gy.min() if len(gy) else 0.
+        self.nx = int((gx.max() - self.x0) // self.cell) + 1 if len(gx) else 1
+        self.ny = int((gy.max() - self.y0) // self.cell) + 1 if len(gy) else 1
+        cells = self._cell(gx, gy)
+        order = numpy.argsort(cells, kind = 'mergesort')
+        self.gx = gx[order]
+        self.gy = gy[order]
+        self.sp = sp[order]
+        self.offsets = numpy.searchsorted(cells[order], numpy.arange(self.nx * self.ny + 1))
+
+    def _cell(self, gx, gy):
+        return ((gx - self.x0) // self.cell).astype('int64') * self.ny + \
+            ((gy - self.y0) // self.cell).astype('int64')
+
+    def query(self, xs, ys, dist):
+        '''the species (as species_getter rows) within dist m (a square, as
+        species_getter) of every point (xs[k], ys[k]), all answered at once'''
+        xs = numpy.asarray(xs, dtype = float)
+        ys = numpy.asarray(ys, dtype = float)
+        n = len(xs)
+        # the range of grid cells each square overlaps, clipped to the grid
+        cx0 = numpy.clip((xs - dist - self.x0) // self.cell, 0, self.nx - 1).astype('int64')
+        cx1 = numpy.clip((xs + dist - self.x0) // self.cell, -1, self.nx - 1).astype('int64')
+        cy0 = numpy.clip((ys - dist - self.y0) // self.cell, 0, self.ny - 1).astype('int64')
+        cy1 = numpy.clip((ys + dist - self.y0) // self.cell, -1, self.ny - 1).astype('int64')
+        # one (point, grid column) pair per overlapped column: the cells of a
+        # column are contiguous in the stem order
+        width = numpy.maximum(cx1 - cx0 + 1, 0)
+        point = numpy.repeat(numpy.arange(n), width)
+        column = ranges(cx0, width)
+        first = self.offsets[column * self.ny + cy0[point]]
+        last = self.offsets[column * self.ny + cy1[point] + 1]
+        count = numpy.maximum(last - first, 0)
+        # the candidate stems of every point, checked against its square
+        point = numpy.repeat(point, count)
+        stem = ranges(first, count)
+        inside = (self.gx[stem] >= xs[point] - dist) & (self.gx[stem] <= xs[point] + dist) & \
+            (self.gy[stem] >= ys[point] - dist) & (self.gy[stem] <= ys[point] + dist)
+        # distinct species of every point
+        pairs = numpy.unique(point[inside] * max(len(self.names), 1) + self.sp[stem[inside]])
+        point = pairs // max(len(self.names), 1)
+        sp = (pairs % max(len(self.names), 1)).tolist()
+        bounds = numpy.searchsorted(point, numpy.arange(n + 1)).tolist()
+        return [[(self.names[k],) for k in sp[bounds[i]:bounds[i + 1]]] for i in xrange(n)]
+
+# set up in every worker process by init_worker
+worker_sequences = None
+
+# number of individuals whose reads are simulated (and written) together
+READ_CHUNK = 10000
+
+def init_worker(sequence_dict):
+    '''give a worker process the sequences'''
+    global worker_sequences
+    worker_sequences = sequence_dict
+
+def simulate_core(work):
+    '''simulate the reads of one virtual soil core, writing them to its
+    fasta file.  work is (core_index, species, count, options, seed): the
+    species names of the core (picker mode), or None to sample count of
+    them.  All random draws of the core come from a generator seeded with
+    (seed, core_index), so a core comes out the same whichever process
+    simulates it.  Returns (core_index, loci), loci holding for each locus
+    the core and read values for the database'''
+    core_index, species, count, options, seed = work
+    rng = numpy.random.RandomState([seed, core_index])
+    sequence_dict = worker_sequences
+    if species is None:
+        # randomly select some species sequence, at each locus that will be in 
+        # our virtual soil core
+        core_species = species_sampler(sequence_dict, count, rng)
+    else:
+        core_species = dict((sp, sequence_dict[sp]) for sp in species)
+    core = len(core_species)
+    core_species_map = core_map(core_species)
+    # use a dirichlet to generate random relative frequencies for the roots
+    # in the virtual soil core.
+    # WARNING: This assumes that we get perfectly equal representation of 
+    #both loci in the virtual core
+    core_true_freq = root_freq(core, options.reads/2, rng)
+    # since adding DNA to PCR reactions is basically a sampling process,
+    # recreate that process by sampling the available pool of species - i,e.
+    # we are probably going to drop some low-count species here, at which we're
+    # interesting in looking
+    #
+    # Similarly, our work in the lab, separating roots from soil will also
+    # mimic a sampling process (perhaps not as random)
+    core_sample, core_sample_freq = dna_sample(core_true_freq, options.sampling_freq, rng)
+    # create a file for the generated sequence reads, written as they are
+    # simulated
+    outp = 'core-%s-%s' % (core_index, options.output)
+    if options.gzip:
+        outp += '.gz'
+    fsa = FastaWriter(outp, options.gzip)
+    loci = []
+    # do this twice, across each locus type???
+    for locus in options.input:
+        locus_name = os.path.basename(locus)
+        # we know that the PCR and sequencing processes entail incorporation of
+        # some error to each read.  Roche 454 would tell us that it's 1%
+        # cumulative from their E. coli work (per Roche rep.) so here, we're going
+        # to create PCR and Sequencing error instances.
+        #
+        # error rates for each error type are held in:
+        # self.homo_error_relative (this is the rate at each homo run)
+        # self.homo_error_overall (this is the homo error rate, over all bases)
+        # self.other_error_overall (this is the non-homo error rate, over all bp)
+        pcr_error = Error(rng = rng, size = len(core_sample), rate = 2.6e-5)
+        sequencing_error = Error(rng = rng, size = 2 * len(core_sample), h_length = 3,
+            h_rate = 0.15, rate = 0.01)
+        # get the species name of every individual
+        names = [core_species_map[individual] for individual in core_sample]
+        lengths = numpy.zeros((len(names), 2), dtype = 'int64')
+        # simulate the individuals in chunks, writing their reads as we go,
+        # so that only one chunk of reads is ever held in memory
+        for first in xrange(0, len(names), READ_CHUNK):
+            chunk = names[first:first + READ_CHUNK]
+            # add some error to the PCR sequences.  This is likely to be a small
+            # rate and this is a vastly oversimplified approximation of a "real"
+            # error generation process (which would be exponenential)
+            # TODO: make process more real
+            pcr_seqs = pcr_error.other_batch([core_species[sp_name][locus].seq for sp_name in chunk])
+            # get read lengths for a particular fragment from both ends; the
+            # reads of individual k are reads[2k] (l) and reads[2k + 1] (r)
+            reads = read_lengths(pcr_seqs, options.average, options.spread, options.skew, rng)
+            # add some error to those reads
+            reads = sequencing_error.homopolymer_batch(reads)
+            reads = sequencing_error.other_batch(reads)
+            for k, read in enumerate(reads):
+                individual_index = first + k // 2
+                lengths[individual_index, k % 2] = len(read)
+                fsa.write(read_header(core_index, individual_index, chunk[k // 2], 'lr'[k % 2], 
+                    locus_name), read)
+        h_error = sequencing_error.homo_error_overall.reshape(-1, 2)
+        s_error = sequencing_error.other_error_overall.reshape(-1, 2)
+        h_err_over = numpy.mean(sequencing_error.homo_error_overall).round(5)
+        s_err_over = numpy.mean(sequencing_error.other_error_overall).round(5)
+        a_err_over = numpy.mean(sequencing_error.homo_error_overall + sequencing_error.other_error_overall).round(3)
+        loci.append((locus_name, int(sum(core_true_freq > 0)), int(sum(core_sample_freq > 0)),
+            h_err_over, s_err_over, a_err_over, names, lengths, h_error, s_error))
+    # close the file
+    fsa.close()
+    return core_index, loci
+
 def main():
-    # setup our R object
-    robj = robjects.r
-    robj.library('sn')
-    robj.options(warn=-1)
     # get and parse our command-line options
     options, args = interface()
+    if options.seed is None:
+        options.seed = random.SystemRandom().randint(0, 2**31 - 1)
+    rng = numpy.random.RandomState(options.seed)
     # create a dbase
     con = sqlite3.connect(options.database)
     c = con.cursor()
+    pragmas(c, options.journal, options.synchronous)
     # create some tables
     tables(c)
     # commit the additions
     con.commit()
     # create a dictionary to hold the sequence of the input files
     sequence_dict = sequence_dictionary(options.input)
+    missing_species = {}
     # generate some counts of species in each virtual root core
     if options.picker == 'False':
-        cores = species_per_core(options.sample, options.sample_sd, options.cores)
+        cores = species_per_core(options.sample, options.sample_sd, options.cores, rng)
+        work = [(core_index, None, core, options, options.seed) for core_index, core in enumerate(cores)]
     else:
-        cores = range(options.cores)
         # connect to the database from which we will be picking
-        bci = sqlite3.connect('../BCI2005.sqlite')
+        bci = sqlite3.connect(options.plots)
         bcur = bci.cursor()
-        missing_species = {}
-    for core_index, core in enumerate(cores):
-        # create a file for the generated sequence reads
-        outp = 'core-%s-%s' % (core_index, options.output)
-        fsa = open(outp, 'w')
-        #pdb.set_trace()
-        if options.picker == 'False':
-            # randomly select some species sequence, at each locus that will be in 
-            # our virtual soil core
-            core_species = species_sampler(sequence_dict, core)
+        xs, ys = random_points(options.cores, rng)
+        if options.spatial == 'grid':
+            core_picks = StemIndex(bcur, max(options.meters, 1.)).query(xs, ys, options.meters)
+        elif options.spatial == 'rtree':
+            rtree(bcur)
+            bci.commit()
+            core_picks = [rtree_species_getter(bcur, x, y, options.meters) for x, y in zip(xs, ys)]
         else:
-            species = species_getter(bcur, options.meters)
-            # get a count of the species in the core
+            core_picks = [species_getter(bcur, x, y, options.meters) for x, y in zip(xs, ys)]
+        bci.close()
+        work = []
+        for core_index, species in enumerate(core_picks):
+            # get the species in the core
             core_species, missing_species = species_picker(sequence_dict, species, missing_species)
-            core = len(core_species)
-        core_species_map = core_map(core_species)
-        # use a dirichlet to generate random relative frequencies for the roots
-        # in the virtual soil core.
-        # WARNING: This assumes that we get perfectly equal representation of 
-        #both loci in the virtual core
-        core_true_freq = root_freq(core, options.reads/2)
-        # since adding DNA to PCR reactions is basically a sampling process,
-        # recreate that process by sampling the available pool of species - i,e.
-        # we are probably going to drop some low-count species here, at which we're
-        # interesting in looking
-        #
-        # Similarly, our work in the lab, separating roots from soil will also
-        # mimic a sampling process (perhaps not as random)
-        core_sample, core_sample_freq = dna_sample(core_true_freq, options.sampling_freq)
-        # create the iterator to hold our sequence data
-        iterator = itertools.chain()
-        # do this twice, across each locus type???
-        #pdb.set_trace()
-        for locus in options.input:
-            # we know that the PCR and sequencing processes entail incorporation of
-            # some error to each read.  Roche 454 would tell us that it's 1%
-            # cumulative from their E. coli work (per Roche rep.) so here, we're going
-            # to create PCR and Sequencing error instances.
-            #
-            # error rates for each error type are held in:
-            # self.homo_error_relative (this is the rate at each homo run)
-            # self.homo_error_overall (this is the homo error rate, over all bases)
-            # self.other_error_overall (this is the non-homo error rate, over all bp)
-            pcr_error = Error(rate = 2.6e-5)
-            sequencing_error = Error(h_length = 3, h_rate = 0.15, rate = 0.01)
+            work.append((core_index, sorted(core_species), None, options, options.seed))
+    # simulate the cores in worker processes, storing their results in core order
+    if options.processes > 1:
+        pool = multiprocessing.Pool(options.processes, init_worker, (sequence_dict,))
+        results = pool.imap(simulate_core, work)
+    else:
+        init_worker(sequence_dict)
+        results = itertools.imap(simulate_core, work)
+    if options.read_rows == 'sqlite':
+        writer = RowWriter(con, options.batch)
+    else:
+        writer = RowWriter(con, options.batch, options.read_rows, 
+            '%s-reads.%s' % (os.path.splitext(options.database)[0], options.read_rows))
+    for core_index, loci in results:
+        for locus, true_count, sample_count, h_err_over, s_err_over, a_err_over, names, lengths, \
+                h_error, s_error in loci:
             # insert the primary virtual core record in the dbase
-            c.execute('''INSERT INTO cores (id, locus, true_count, sample_count) VALUES 
-            (?,?,?,?)''', (core_index, os.path.basename(locus), int(sum(core_true_freq > 0)), 
-            int(sum(core_sample_freq > 0))))
+            writer.add('cores', [(core_index, locus, true_count, sample_count, h_err_over, 
+                s_err_over, a_err_over)])
             # insert the individual reads record to the dbase, referencing
             # the core and locus, which are the primary keys.
-            for individual_index, individual in enumerate(core_sample):
-                # get the species name of the read
-                try:
-                    sp_name = core_species_map[individual]
-                except:
-                    pdb.set_trace()
-                # get the the voucher read for the species
-                record  = core_species[sp_name][locus]
-                # add some error to the PCR sequences.  This is likely to be a small
-                # rate and this is a vastly oversimplified approximation of a "real"
-                # error generation process (which would be exponenential)
-                # TODO: make process more real
-                pcr_seq = pcr_error.other(record.seq)
-                #pdb.set_trace()
-                # get read lengths for a particular fragment from both ends
-                reads = read_lengths(robj, pcr_seq, options.average, options.spread, options.skew)
-                # add some error to those reads
-                reads = sequencing_error.homopolymer(reads[0]), sequencing_error.homopolymer(reads[1])
-                h_error = sequencing_error.homo_error_overall[-2:]
-                reads = sequencing_error.other(reads[0]), sequencing_error.other(reads[1])
-                s_error = sequencing_error.other_error_overall[-2:]
-                insert_read_row(c, core_index, os.path.basename(locus), individual_index, sp_name, reads, h_error, s_error)
-                for i, side in enumerate(['l','r']):
-                    iterator = itertools.chain(iterator, write_reads(i, os.path.basename(locus), side, fsa, core_index, individual_index, sp_name, reads, h_error, s_error))
-            #pdb.set_trace()
-            h_err_over = numpy.mean(sequencing_error.homo_error_overall).round(5)
-            s_err_over = numpy.mean(sequencing_error.other_error_overall).round(5)
-            a_err_over = numpy.mean(sequencing_error.homo_error_overall + sequencing_error.other_error_overall).round(3)
-            c.execute('''UPDATE cores set homo_error = ?, other_error = ?, 
-            all_error = ? WHERE id = ? and locus = ?''', (h_err_over, s_err_over, a_err_over, core_index, os.path.basename(locus)))
-        SeqIO.write(iterator, fsa, "fasta")
-        # close the file
-        fsa.close()
-        #pdb.set_trace()  
+            writer.add('reads', read_rows(core_index, locus, names, lengths, h_error, s_error))
+    writer.close()
+    if options.read_rows == 'sqlite':
+        indexes(c)
+        con.commit()
+    print 'wrote', writer.written, 'rows in', round(writer.seconds, 1), 'seconds'
+    if options.processes > 1:
+        pool.close()
+        pool.join()
     #pdb.set_trace()
     params = open('simulation.params.txt','w')
     params.write('%s' % options)